@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""analytics.py - Offline statistics computed from the CSV chunks written by
+export.py, without touching the datastore. The chunks are loaded into columns
+(one list per field), and the statistics are computed column by column:
+per word and per user plays, wins, win rates and scores, and the
+distribution of the number of guesses of finished games.
+
+Usage:
+    python analytics.py DIRECTORY"""
+
+import csv
+import glob
+import os
+import sys
+from collections import defaultdict
+
+INT_COLUMNS = frozenset(['won', 'guesses', 'attempts_allowed',
+                         'attempts_remaining', 'game_over', 'cancelled'])
+FLOAT_COLUMNS = frozenset(['score'])
+
+
+def load_columns(directory, prefix):
+    """Returns a dict mapping each column of the chunks with the prefix to
+    the list of its values"""
+    columns = defaultdict(list)
+    for path in sorted(glob.glob(os.path.join(directory,
+                                              prefix + '-*.csv'))):
+        with open(path, 'rb') as chunk:
+            reader = csv.reader(chunk)
+            header = next(reader)
+            converters = [_converter(name) for name in header]
+            values = [columns[name] for name in header]
+            for row in reader:
+                for column, convert, value in zip(values, converters, row):
+                    column.append(convert(value))
+    return dict(columns)
+
+
+def _converter(name):
+    if name in INT_COLUMNS:
+        return int
+    if name in FLOAT_COLUMNS:
+        return float
+    return lambda value: value.decode('utf-8')
+
+
+def group_stats(keys, won, score, guesses):
+    """Returns a dict mapping each key to a dict with its plays, wins,
+    win_rate, mean_score, best_score and mean_guesses, from four parallel
+    columns"""
+    plays = defaultdict(int)
+    wins = defaultdict(int)
+    score_sum = defaultdict(float)
+    guesses_sum = defaultdict(int)
+    best_score = {}
+    for key, key_won, key_score, key_guesses in zip(keys, won, score,
+                                                    guesses):
+        plays[key] += 1
+        wins[key] += key_won
+        score_sum[key] += key_score
+        guesses_sum[key] += key_guesses
+        if key_score > best_score.get(key, float('-inf')):
+            best_score[key] = key_score
+    return dict((key, {'plays': plays[key],
+                       'wins': wins[key],
+                       'win_rate': float(wins[key]) / plays[key],
+                       'mean_score': score_sum[key] / plays[key],
+                       'best_score': best_score[key],
+                       'mean_guesses': float(guesses_sum[key]) / plays[key]})
+                for key in plays)
+
+
+def guesses_distribution(guesses):
+    """Returns a dict mapping each number of guesses to its count"""
+    distribution = defaultdict(int)
+    for count in guesses:
+        distribution[count] += 1
+    return dict(distribution)
+
+
+def word_stats(scores):
+    return group_stats(scores['word_to_guess'], scores['won'],
+                       scores['score'], scores['guesses'])
+
+
+def user_stats(scores):
+    return group_stats(scores['user_name'], scores['won'], scores['score'],
+                       scores['guesses'])
+
+
+def _print_stats(title, stats):
+    print title
+    print '{:<24} {:>7} {:>7} {:>9} {:>11} {:>11} {:>8}'.format(
+        'key', 'plays', 'wins', 'win rate', 'mean score', 'best score',
+        'guesses')
+    for key, row in sorted(stats.items(), key=lambda item: -item[1]['plays']):
+        print u'{:<24} {:>7} {:>7} {:>9.2f} {:>11.2f} {:>11.2f} {:>8.2f}'\
+            .format(key, row['plays'], row['wins'], row['win_rate'],
+                    row['mean_score'], row['best_score'],
+                    row['mean_guesses']).encode('utf-8')
+    print
+
+
+def main():
+    if len(sys.argv) != 2:
+        print __doc__
+        sys.exit(1)
+    scores = load_columns(sys.argv[1], 'scores')
+    if not scores:
+        print 'No scores found in {}'.format(sys.argv[1])
+        sys.exit(1)
+    _print_stats('Words', word_stats(scores))
+    _print_stats('Users', user_stats(scores))
+    print 'Guesses of finished games'
+    for count, games in sorted(
+            guesses_distribution(scores['guesses']).items()):
+        print '{:>3} {}'.format(count, games)
+
+
+if __name__ == '__main__':
+    main()
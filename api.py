@@ -7,16 +7,31 @@ History, informing the guesses made in that game and the messages returned for
 each guess."""
 
 
+import logging
+import time
+
 import endpoints
 from protorpc import remote, messages
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
-
-from models import User, Game, Score
-from models import StringMessage, NewGameForm, GameForm, MakeGuessForm,\
-    ScoreForms, GameForms, HighScoreForms, RankingForm, RankingForms,\
-    GameHistoryForm, GameHistoryForms
-from utils import get_by_urlsafe
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, ActiveGamesShard, WordStatsShard,\
+    Leaderboard, Puzzle, EventResultsShard, GUESS_MESSAGES
+from models import StringMessage, NewGameForm, NewGameForms, GameForm,\
+    MakeGuessForm, MakeGuessesForm, GuessesResultForm,\
+    ScoreForms, GameForms, HighScoreForms, RankingForms,\
+    GameHistoryForm, GameHistoryForms, CacheStatsForm, EndpointStatsForm,\
+    EndpointStatsForms, WordStatsForm, UserProfileForm, NewEventForm,\
+    EventForm, EventResultsForm
+import engine
+from dictionary import DIFFICULTIES, get_dictionary
+from instrumentation import instrumented, add_stat, get_endpoint_stats
+from ratelimit import rate_limited
+from utils import get_key_by_urlsafe, get_game_by_urlsafe,\
+    get_game_by_urlsafe_coalesced, cache_game, get_game_cache_stats,\
+    fetch_page
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -24,13 +39,46 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
 MAKE_GUESS_REQUEST = endpoints.ResourceContainer(
     MakeGuessForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_GUESSES_REQUEST = endpoints.ResourceContainer(
+    MakeGuessesForm,
+    urlsafe_game_key=messages.StringField(1),)
+WORD_REQUEST = endpoints.ResourceContainer(word=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 
+USER_NAME_REQUEST = endpoints.ResourceContainer(
+                    user_name=messages.StringField(1),)
+
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+                    user_name=messages.StringField(1),
+                    page_size=messages.IntegerField(2),
+                    page_token=messages.StringField(3),)
+
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
-                      results_to_show=messages.IntegerField(1),)
+                      results_to_show=messages.IntegerField(1),
+                      page_token=messages.StringField(2),)
+
+HIGH_SCORES_WINDOW_REQUEST = endpoints.ResourceContainer(
+                             window=messages.StringField(1),)
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+NEW_EVENT_REQUEST = endpoints.ResourceContainer(NewEventForm)
+EVENT_REQUEST = endpoints.ResourceContainer(
+                urlsafe_event_key=messages.StringField(1),)
+JOIN_EVENT_REQUEST = endpoints.ResourceContainer(
+                     urlsafe_event_key=messages.StringField(1),
+                     user_name=messages.StringField(2),)
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+               page_size=messages.IntegerField(1),
+               page_token=messages.StringField(2),)
+
+# Maximum number of games created by one call of new_games_batch
+MAX_NEW_GAMES_BATCH = 500
+# Times guesses are evaluated and written before a conflict is reported
+GUESS_ATTEMPTS = 3
+
+# Seconds covered by each named task that caches the average moves remaining
+AVERAGE_ATTEMPTS_TASK_PERIOD = 10
 
 @endpoints.api(name='hangman', version='v1')
 class HangmanApi(remote.Service):
@@ -40,14 +88,15 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
+    @rate_limited
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name or not request.user_name.strip():
+            raise endpoints.BadRequestException('A user name is required!')
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email,
-                    games_played=0, wins=0, average_score=0.0)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -56,36 +105,132 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
+    @rate_limited
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        game = Game.new_game(user.key, request.word_to_guess.lower(),
+        game = Game.new_game(user.key, _word_to_guess(request),
                              request.attempts)
 
         # Use a task queue to update the average attempts remaining.
         # This operation is not needed to complete the creation of a new game
         # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
+        _enqueue_cache_average_attempts()
+        return game.to_form('Try to guess the word!', user.name)
+
+    @endpoints.method(request_message=NewGameForms,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games_batch',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    def new_games_batch(self, request):
+        """Creates many new games, for one or many users, at once"""
+        if not request.items:
+            raise endpoints.BadRequestException('No games were sent.')
+        if len(request.items) > MAX_NEW_GAMES_BATCH:
+            raise endpoints.BadRequestException(
+                    'At most {} games can be created at once.'.format(
+                        MAX_NEW_GAMES_BATCH))
+        user_keys = User.get_keys_by_names([item.user_name
+                                            for item in request.items])
+        for item in request.items:
+            if item.user_name not in user_keys:
+                raise endpoints.NotFoundException(
+                    'A User with the name {} does not exist!'.format(
+                        item.user_name))
+        games = Game.new_games([(user_keys[item.user_name],
+                                 _word_to_guess(item), item.attempts)
+                                for item in request.items])
+
+        # A single task updates the average attempts remaining of the batch
+        _enqueue_cache_average_attempts()
+        return GameForms(items=Game.to_forms(games, 'Try to guess the word!'))
+
+    @endpoints.method(request_message=NEW_EVENT_REQUEST,
+                      response_message=EventForm,
+                      path='event',
+                      name='create_event',
+                      http_method='POST')
+    @instrumented
+    def create_event(self, request):
+        """Creates an event, where every player guesses the same word"""
+        if not request.name or not request.name.strip():
+            raise endpoints.BadRequestException('An event name is required!')
+        puzzle = Puzzle(name=request.name,
+                        word_to_guess=_word_to_guess(request),
+                        attempts=request.attempts)
+        puzzle.put()
+        return puzzle.to_form()
+
+    @endpoints.method(request_message=JOIN_EVENT_REQUEST,
+                      response_message=GameForm,
+                      path='event/{urlsafe_event_key}/join',
+                      name='join_event',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    def join_event(self, request):
+        """Returns the game of a User in an event, creating it the first time
+        the User joins. The game is played with make_guess."""
+        user_key = User.get_key_by_name(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        puzzle = _get_puzzle(request.urlsafe_event_key)
+        game = Game.join_event(user_key, puzzle)
+        _enqueue_cache_average_attempts()
         return game.to_form('Try to guess the word!')
 
+    @endpoints.method(request_message=EVENT_REQUEST,
+                      response_message=EventResultsForm,
+                      path='event/{urlsafe_event_key}/results',
+                      name='get_event_results',
+                      http_method='GET')
+    @instrumented
+    def get_event_results(self, request):
+        """Return the number of players, wins, average score and best results
+        of an event. The results are aggregated as the players finish, so
+        reading them does not depend on the number of players."""
+        puzzle = _get_puzzle(request.urlsafe_event_key)
+        results = EventResultsShard.results(puzzle.key)
+        finished = results['finished']
+        return EventResultsForm(
+            event=puzzle.to_form(),
+            players=results['players'],
+            finished=finished,
+            wins=results['wins'],
+            average_score=(results['score_sum'] / finished if finished
+                           else 0.0),
+            items=[EventResultsShard.entry_to_form(entry)
+                   for entry in results['entries']])
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return the current game state. Concurrent reads of the same game
+        on an instance share one fetch."""
+        game, user_name = get_game_by_urlsafe_coalesced(
+            request.urlsafe_game_key)
         if game:
             if game.game_over == True:
-                return game.to_form('This game is over. Check stats about it')
+                return game.to_form('This game is over. Check stats about it',
+                                    user_name)
             elif game.cancelled == True:
-                return game.to_form('Game cancelled. Check stats about it')
+                return game.to_form('Game cancelled. Check stats about it',
+                                    user_name)
             else:
-                return game.to_form('One more attempt to guess!')
+                return game.to_form('One more attempt to guess!', user_name)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -94,13 +239,17 @@ class HangmanApi(remote.Service):
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
+    @rate_limited
     def cancel_game(self, request):
         """Cancel current game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game, user_name = get_game_by_urlsafe(request.urlsafe_game_key)
         if game:
             msg = game.cancel_game()
+            cache_game(game, user_name)
+            _enqueue_cache_average_attempts()
 
-            return game.to_form(msg)
+            return game.to_form(msg, user_name)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -109,204 +258,386 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_guess',
                       http_method='PUT')
+    @instrumented
+    @rate_limited
     def make_guess(self, request):
         """Makes a guess. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        user = User.query(User.key == game.user).get()
-        print(user.key)
-
-        # Set up restrictions for making a guess, such as game should not be
-        # cancelled or over
-        if game.game_over:
-            raise endpoints.ForbiddenException('Illegal action: Game is already over.')
-
-        if game.cancelled:
-            return game.to_form('Game cancelled')
-
-        if (request.guess).isalpha() == False:
-            return game.to_form('Your guess must be a letter.')
-
-        if request.guess in game.letters_tried:
-            return game.to_form('This letter was already tried.')
-
-        if len(request.guess) > 1:
-            return game.to_form('Your guess must be one letter only.')
-
-
-        # Register the current guess
-        game.letters_tried = game.letters_tried + ((request.guess).lower())
-        game.guesses.append(request.guess.lower())
-
-        # If the guessed letter is in the word to be guessed
-        if (request.guess).lower() in game.word_to_guess:
-            # Generate list of positions (index) of the letter guessed in
-            # the string
-            positions = [pos for pos, char in enumerate(game.word_to_guess) if \
-                         char == request.guess]
-            new_current_word = game.current_word
-
-            # Generate a string with the letters already guessed by the player
-            for position in positions:
-                new_current_word = (new_current_word[:position] +
-                                    request.guess +
-                                    new_current_word[position + 1:])
-            game.current_word = new_current_word
-
-            # String with the letters yet to be guessed
-            game.word_remaining = (game.word_remaining).replace(request.guess,
-                                                                "")
-            # If there is nothing else to guess
-            if game.word_remaining == "":
-                msg = 'You win!'
-                game.messages_history.append(msg)
-                game.end_game(True)
-
-                # Update user information for ranking after win
-                user.games_played += 1
-                user.wins += 1
-                user.put()
-
-                return game.to_form(msg)
-            else:
-                msg = 'This letter is in the word. You can continue guessing.'
-        else:
-            # An attempt is only deduced if the guess is wrong
-            msg = 'This letter is not in the word to be guessed!'
-            game.attempts_remaining -= 1
-
-        # If guess is wrong and there is no more attempts remaining, game is
-        # over
-        if game.attempts_remaining < 1:
-            msg = msg + ' Game over!'
-            game.messages_history.append(msg)
-            game.end_game(False)
-
-            # Update user information for ranking after loss
-            user.games_played += 1
-            user.put()
-
-            return game.to_form(msg)
+        game, user_name, results = self._make_guesses(
+            request.urlsafe_game_key, [request.guess])
+        cache_game(game, user_name)
+        _enqueue_cache_average_attempts()
+        return game.to_form(results[0][1], user_name)
+
+    @endpoints.method(request_message=MAKE_GUESSES_REQUEST,
+                      response_message=GuessesResultForm,
+                      path='game/{urlsafe_game_key}/guesses',
+                      name='make_guesses',
+                      http_method='PUT')
+    @instrumented
+    @rate_limited
+    def make_guesses(self, request):
+        """Makes an ordered list of guesses in one transaction. Returns the
+        final game state and the message of each guess"""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses were sent.')
+        if len(request.guesses) > len(engine.LETTERS):
+            raise endpoints.BadRequestException(
+                    'At most {} guesses can be sent.'.format(
+                        len(engine.LETTERS)))
+        game, user_name, results = self._make_guesses(
+            request.urlsafe_game_key, request.guesses)
+        cache_game(game, user_name)
+        _enqueue_cache_average_attempts()
+        return GuessesResultForm(
+            game=game.to_form(results[-1][1], user_name),
+            results=[GameHistoryForm(guess=guess, message=msg)
+                     for guess, msg in results])
+
+    @staticmethod
+    def _make_guesses(urlsafe_game_key, guesses):
+        """Applies guesses to a game, retrying version conflicts. Returns the
+        game, its owner's name and a list of (guess, message) tuples."""
+        game, user_name = get_game_by_urlsafe(urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        for attempt in range(GUESS_ATTEMPTS):
+            if attempt:
+                add_stat('guess_retries')
+                game = game.key.get(use_cache=False)
+
+            # Set up restrictions for making a guess, such as game should not
+            # be cancelled or over. Only finished games are archived.
+            if not game or game.game_over:
+                raise endpoints.ForbiddenException(
+                        'Illegal action: Game is already over.')
+
+            if game.cancelled:
+                return game, user_name, [(guess, 'Game cancelled')
+                                         for guess in guesses]
+
+            version = game.version
+            attempts_remaining = game.attempts_remaining
+            outcome, played, results = _play_guesses(game, guesses)
+            if not played:
+                return game, user_name, results
+            try:
+                written = HangmanApi._write_guesses_async(
+                    game, user_name, version, outcome).get_result()
+            except datastore_errors.TransactionFailedError:
+                # The commit failed without the version being checked
+                continue
+            if written:
+                if (not game.game_over and
+                        game.attempts_remaining != attempts_remaining):
+                    _count_attempts(game.attempts_remaining -
+                                    attempts_remaining)
+                return game, user_name, results
+            add_stat('guess_conflicts')
+        raise endpoints.ConflictException(
+                'The game is being played by other requests, try again.')
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True, retries=0)
+    def _write_guesses_async(game, user_name, version, outcome):
+        """Writes the game if its stored version is still version. Returns
+        whether it was written."""
+        stored = yield game.key.get_async()
+        if stored is None or stored.version != version:
+            raise ndb.Return(False)
+        if outcome in (engine.WIN, engine.LOSS):
+            yield game.end_game_async(outcome == engine.WIN, user_name,
+                                      stored.attempts_remaining)
         else:
-            game.messages_history.append(msg)
-            game.put()
-            return game.to_form(msg)
+            yield game.put_async()
+        raise ndb.Return(True)
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return one page of all scores"""
+        scores, next_page_token = fetch_page(Score.query(), request.page_size,
+                                             request.page_token)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_page_token=next_page_token)
 
     @endpoints.method(request_message=HIGH_SCORES_REQUEST,
                       response_message=HighScoreForms,
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
-        """Return high scores (scores ordered by the Score property)"""
-        if not request.results_to_show:
-            q = Score.query().order(-Score.score)
-        else:
-            q = Score.query().order(-Score.score).fetch(
-                                                limit=request.results_to_show)
-        return HighScoreForms(items=[score.to_form() for score in q])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return high scores (scores ordered by the Score property). The
+        results_to_show argument is the size of the page."""
+        scores, next_page_token = fetch_page(
+            Score.query().order(-Score.score), request.results_to_show,
+            request.page_token)
+        return HighScoreForms(results_to_show=len(scores),
+                              items=Score.to_forms(scores),
+                              next_page_token=next_page_token)
+
+    @endpoints.method(request_message=HIGH_SCORES_WINDOW_REQUEST,
+                      response_message=HighScoreForms,
+                      path='high_scores/{window}',
+                      name='get_windowed_high_scores',
+                      http_method='GET')
+    @instrumented
+    def get_windowed_high_scores(self, request):
+        """Return the best scores of today, of this week or of all time. The
+        boards are precomputed when games end."""
+        if request.window not in Leaderboard.PERIODS:
+            raise endpoints.BadRequestException(
+                    'The window must be one of: {}.'.format(
+                        ', '.join(Leaderboard.PERIODS)))
+        entries = Leaderboard.get_entries(request.window)
+        return HighScoreForms(results_to_show=len(entries),
+                              items=[Leaderboard.entry_to_form(entry)
+                                     for entry in entries])
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns one page of an individual User's scores"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_page_token = fetch_page(
+            Score.query(Score.user == user.key), request.page_size,
+            request.page_token)
+        return ScoreForms(items=[score.to_form(user.name) for score in scores],
+                          next_page_token=next_page_token)
+
+    @endpoints.method(request_message=USER_NAME_REQUEST,
+                      response_message=UserProfileForm,
+                      path='user/{user_name}/profile',
+                      name='get_user_profile',
+                      http_method='GET')
+    @instrumented
+    def get_user_profile(self, request):
+        """Returns the games played, wins, scores and current winning streak
+        of a User. The aggregates are updated by the task that folds the
+        results of the games the User ended and cached, so a profile is
+        usually one memcache hit."""
+        key = User.get_key_by_name(request.user_name)
+        profile = User.get_profile(key) if key else None
+        if not profile:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        return profile
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or
-                             '')
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Get the cached average moves remaining. On a cache miss it is
+        computed again from the active games counter."""
+        message = memcache.get(ActiveGamesShard.MEMCACHE_AVERAGE_ATTEMPTS)
+        if message is None:
+            message = ActiveGamesShard.cache_average_attempts()
+        return StringMessage(message=message)
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns one page of an individual User's active games"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key,
-                           Game.cancelled == False,
-                           Game.game_over == False).fetch()        
+        games, next_page_token = fetch_page(
+            Game.query(Game.user == user.key,
+                       Game.cancelled == False,
+                       Game.game_over == False),
+            request.page_size, request.page_token)
         return GameForms(items=[game.to_form('Returning game for user:' +
-                                             user.name) for game in games])
+                                             user.name, user.name)
+                                for game in games],
+                         next_page_token=next_page_token)
 
-    @endpoints.method(response_message=RankingForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=RankingForms,
                       path='rankings',
                       name='get_rankings',
                       http_method='GET')
+    @instrumented
     def get_rankings(self, request):
         """Return the rankings. The order is based on the winning percentage and
-         the average score of the user."""
-        users = User.query().order(-User.winning_percentage).fetch()
-        rankings_list = []
-        for user in users:
-            user_name = user.name
-            winning_percentage = user.winning_percentage
-            user_scores = Score.query(Score.user == user.key).fetch()
-            if len(user_scores) == 0:
-                average_score = 0.0
-            else:
-                sum_user_scores = sum([score.score for score in user_scores])
-                print(sum_user_scores)
-                average_score = sum_user_scores / float(len(user_scores))
-            rankings_list.append(RankingForm(user_name=user_name,
-                                         winning_percentage=winning_percentage,
-                                         average_score=average_score))
-        sorted(rankings_list, key=lambda x: (-x.winning_percentage,
-                                             x.average_score))
-        return RankingForms(items=rankings_list)
+         the average score of the user. The aggregates are kept up to date on
+         the User by the fold task of UserResultsShard, so a page costs one
+         indexed query."""
+        q = User.query().order(-User.winning_percentage, -User.average_score)
+        users, next_page_token = fetch_page(q, request.page_size,
+                                            request.page_token)
+        return RankingForms(items=[user.to_ranking_form() for user in users],
+                            next_page_token=next_page_token)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameHistoryForms,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_game_history(self, request):
         """Return the Game history, with the guesses and messages returned
         for each guess."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game, _ = get_game_by_urlsafe(request.urlsafe_game_key)
         history_list = []
         if game:
-            for i, guess in enumerate(game.guesses):
-                history_list.append(GameHistoryForm(guess=game.guesses[i],
-                                            message=game.messages_history[i]))
+            for guess, message in game.history():
+                history_list.append(GameHistoryForm(guess=guess,
+                                                    message=message))
             return GameHistoryForms(items=history_list)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+    @endpoints.method(request_message=WORD_REQUEST,
+                      response_message=WordStatsForm,
+                      path='words/{word}/stats',
+                      name='get_word_stats',
+                      http_method='GET')
+    @instrumented
+    def get_word_stats(self, request):
+        """Return the number of finished games, wins and win rate of a word"""
+        word = (request.word or '').lower()
+        plays, wins = WordStatsShard.totals(word)
+        return WordStatsForm(word=word, plays=plays, wins=wins,
+                             win_rate=float(wins) / plays if plays else 0.0)
+
+    @endpoints.method(response_message=CacheStatsForm,
+                      path='stats/game_cache',
+                      name='get_game_cache_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_cache_stats(self, request):
+        """Return the hit and miss counters of the game state cache"""
+        hits, misses = get_game_cache_stats()
+        lookups = hits + misses
+        return CacheStatsForm(hits=hits, misses=misses,
+                              hit_ratio=float(hits) / lookups if lookups
+                              else 0.0)
+
+    @endpoints.method(response_message=EndpointStatsForms,
+                      path='stats/endpoints',
+                      name='get_endpoint_stats',
+                      http_method='GET')
+    @instrumented
+    def get_endpoint_stats(self, request):
+        """Return the mean wall time and App Engine RPCs per call of each
+        endpoint, aggregated over all instances"""
+        items = []
+        for endpoint, stats in sorted(get_endpoint_stats().items()):
+            calls = stats['calls']
+            if not calls:
+                continue
+            lookups = stats['memcache_lookups']
+            items.append(EndpointStatsForm(
+                endpoint=endpoint,
+                calls=calls,
+                mean_wall_ms=float(stats['wall_ms']) / calls,
+                mean_datastore_gets=float(stats['datastore_gets']) / calls,
+                mean_datastore_puts=float(stats['datastore_puts']) / calls,
+                mean_datastore_queries=(float(stats['datastore_queries']) /
+                                        calls),
+                memcache_hit_ratio=(float(stats['memcache_hits']) / lookups
+                                    if lookups else 0.0),
+                mean_taskqueue_adds=float(stats['taskqueue_adds']) / calls,
+                mean_ratelimit_ms=float(stats['ratelimit_us']) / 1000 / calls,
+                throttled=stats['throttled'],
+                coalesced_reads=stats['coalesced_reads'],
+                guess_conflicts=stats['guess_conflicts'],
+                guess_retries=stats['guess_retries']))
+        return EndpointStatsForms(items=items)
+
+def _play_guesses(game, guesses):
+    """Plays an ordered list of guesses on a game, without writing it.
+    Returns a tuple with the outcome of the last guess played, the number of
+    guesses that changed the game and a list of (guess, message) tuples."""
+    results = []
+    outcome = None
+    played = 0
+    for guess in guesses:
+        if outcome in (engine.WIN, engine.LOSS):
+            results.append((guess, 'Game is already over.'))
+            continue
+        outcome = game.guess(guess.lower())
+        if outcome in (engine.HIT, engine.MISS, engine.WIN, engine.LOSS):
+            played += 1
+        results.append((guess, GUESS_MESSAGES[outcome]))
+    return outcome, played, results
+
+
+def _count_attempts(attempts_remaining):
+    """Adds the attempts lost by a game in play to the active games
+    counter"""
+    try:
+        ActiveGamesShard.increment_async(0, attempts_remaining).get_result()
+    except datastore_errors.TransactionFailedError:
+        logging.warning('Could not add %d attempts remaining to the active '
+                        'games counter', attempts_remaining)
+
+
+def _get_puzzle(urlsafe_event_key):
+    """Returns the Puzzle of an event, read through the per instance cache"""
+    puzzle = Puzzle.get_cached(get_key_by_urlsafe(urlsafe_event_key, Puzzle))
+    if not puzzle:
+        raise endpoints.NotFoundException('Event not found!')
+    return puzzle
+
+
+def _word_to_guess(form):
+    """Returns the word of a NewGameForm or NewEventForm. Without
+    word_to_guess, a random word of the dictionary with the word_length and
+    difficulty of the form is picked."""
+    if form.word_to_guess:
+        word = form.word_to_guess.lower()
+        if not engine.is_valid_word(word):
+            raise endpoints.BadRequestException(
+                'The word to guess must only have letters from a to z.')
+        return word
+    if form.difficulty and form.difficulty not in DIFFICULTIES:
+        raise endpoints.BadRequestException(
+            'The difficulty must be one of: {}.'.format(
+                ', '.join(DIFFICULTIES)))
+    word = get_dictionary().random_word(form.word_length, form.difficulty)
+    if not word:
+        raise endpoints.BadRequestException(
+            'There is no word with that length and difficulty.')
+    return word
+
+
+_last_average_attempts_task = [None]
+
+
+def _enqueue_cache_average_attempts():
+    """Enqueues the task that caches the average moves remaining. Tasks are
+    named after a period of AVERAGE_ATTEMPTS_TASK_PERIOD seconds and run at
+    its end, so all the changes in a period are coalesced into one task."""
+    period = int(time.time() // AVERAGE_ATTEMPTS_TASK_PERIOD)
+    if _last_average_attempts_task[0] == period:
+        return
+    try:
+        taskqueue.add(url='/tasks/cache_average_attempts',
+                      name='cache-average-attempts-{}'.format(period),
+                      countdown=AVERAGE_ATTEMPTS_TASK_PERIOD)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    _last_average_attempts_task[0] = period
+
 
 api = endpoints.api_server([HangmanApi])
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Load test of the Hangman API against the App Engine testbed
+stubs (datastore_v3, memcache and taskqueue). It seeds users, games and scores,
+drives a weighted mix of endpoint calls and reports, for each endpoint, the
+latency percentiles and the datastore RPCs made per call. The report is
+compared against a baseline recorded with --save-baseline (see perftools.py).
+
+Usage:
+    python benchmark.py --sdk PATH_TO_GOOGLE_APPENGINE [--save-baseline]
+
+Exits with status 1 if an endpoint regressed against the baseline."""
+
+import argparse
+import os
+import random
+import string
+import time
+from collections import defaultdict
+from datetime import date
+
+import perftools
+
+# Relative weights of the calls made after seeding
+MIX = [
+    ('create_user', 2),
+    ('new_game', 8),
+    ('make_guess', 50),
+    ('get_game', 20),
+    ('get_high_scores', 10),
+    ('get_rankings', 10),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    perftools.add_arguments(parser, 'benchmark_baseline.json')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--scores', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random mix, for repeatable runs')
+    return parser.parse_args()
+
+
+def random_word(rng, min_length=4, max_length=10):
+    return ''.join(rng.choice(string.ascii_lowercase)
+                   for _ in range(rng.randint(min_length, max_length)))
+
+
+class RpcCounter(object):
+    """Counts the App Engine API calls made through the apiproxy"""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def count(self, service, call, request, response):
+        """apiproxy pre-call hook. The hooks must be functions or methods,
+        since the SDK inspects their arguments."""
+        self.counts['{}.{}'.format(service, call)] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+    def datastore_calls(self):
+        return sum(count for name, count in self.counts.items()
+                   if name.startswith('datastore_v3.'))
+
+
+class Benchmark(object):
+    """Seeds the datastore and drives the mix of calls"""
+
+    def __init__(self, args, rng):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb, testbed
+
+        import api
+        import models
+        self.api = api
+        self.models = models
+        self.ndb = ndb
+        self.args = args
+        self.rng = rng
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.testbed.init_app_identity_stub()
+
+        self.rpcs = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self.rpcs.count)
+
+        self.service = api.HangmanApi()
+        self.user_names = []
+        self.game_keys = []
+        self.latencies = defaultdict(list)
+        self.datastore_rpcs = defaultdict(list)
+
+    def seed(self):
+        """Creates the users, active games and scores of the run"""
+        models = self.models
+        users = [models.User(name='user{}'.format(i),
+                             email='user{}@example.com'.format(i))
+                 for i in range(self.args.users)]
+        self.ndb.put_multi(users)
+        self.ndb.put_multi([models.UserName(id=user.name, user=user.key)
+                            for user in users])
+        self.user_names = [user.name for user in users]
+
+        for _ in range(self.args.games):
+            user = self.rng.choice(users)
+            game = models.Game.new_game(user.key, random_word(self.rng), 6)
+            self.game_keys.append(game.key.urlsafe())
+
+        scores = []
+        for _ in range(self.args.scores):
+            user = self.rng.choice(users)
+            won = self.rng.random() < 0.5
+            score = models.Score(user=user.key, date=date.today(), won=won,
+                                 guesses=self.rng.randint(1, 26),
+                                 word_to_guess=random_word(self.rng),
+                                 score=self.rng.uniform(0, 10))
+            user.record_result(won, score.score)
+            scores.append(score)
+        self.ndb.put_multi(scores + users)
+
+    def call(self, endpoint, request_container, **fields):
+        """Calls an endpoint, recording its latency and datastore RPCs"""
+        if request_container is None:
+            from protorpc import message_types
+            request = message_types.VoidMessage()
+        else:
+            request = request_container.combined_message_class(**fields)
+        self.ndb.get_context().clear_cache()
+        self.rpcs.reset()
+        start = time.time()
+        try:
+            return getattr(self.service, endpoint)(request)
+        except Exception, e:
+            # Endpoints errors such as a guess on a finished game are part of
+            # a realistic mix; other errors are bugs.
+            if not hasattr(e, 'http_status'):
+                raise
+        finally:
+            self.latencies[endpoint].append((time.time() - start) * 1000)
+            self.datastore_rpcs[endpoint].append(self.rpcs.datastore_calls())
+
+    def run(self):
+        api = self.api
+        names = [name for name, weight in MIX for _ in range(weight)]
+        for i in range(self.args.calls):
+            endpoint = self.rng.choice(names)
+            if endpoint == 'create_user':
+                name = 'bench{}'.format(i)
+                self.call(endpoint, api.USER_REQUEST, user_name=name)
+                self.user_names.append(name)
+            elif endpoint == 'new_game':
+                form = self.call(endpoint, api.NEW_GAME_REQUEST,
+                                 user_name=self.rng.choice(self.user_names),
+                                 word_to_guess=random_word(self.rng),
+                                 attempts=6)
+                self.game_keys.append(form.urlsafe_key)
+            elif endpoint == 'make_guess':
+                self.call(endpoint, api.MAKE_GUESS_REQUEST,
+                          urlsafe_game_key=self.rng.choice(self.game_keys),
+                          guess=self.rng.choice(string.ascii_lowercase))
+            elif endpoint == 'get_game':
+                self.call(endpoint, api.GET_GAME_REQUEST,
+                          urlsafe_game_key=self.rng.choice(self.game_keys))
+            elif endpoint == 'get_high_scores':
+                self.call(endpoint, api.HIGH_SCORES_REQUEST,
+                          results_to_show=20)
+            elif endpoint == 'get_rankings':
+                self.call(endpoint, api.PAGE_REQUEST)
+
+    def report(self):
+        """Returns the percentiles and mean datastore RPCs per endpoint"""
+        report = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            stats = {'calls': len(latencies)}
+            for percentile in PERCENTILES:
+                index = min(len(latencies) - 1,
+                            int(len(latencies) * percentile / 100.0))
+                stats['p{}_ms'.format(percentile)] = latencies[index]
+            rpcs = self.datastore_rpcs[endpoint]
+            stats['datastore_rpcs'] = float(sum(rpcs)) / len(rpcs)
+            report[endpoint] = stats
+        return report
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+def print_report(report):
+    """Prints the stats of each endpoint"""
+    print '{:<16} {:>6} {:>9} {:>9} {:>9} {:>8}'.format(
+        'endpoint', 'calls', 'p50 ms', 'p90 ms', 'p99 ms', 'ds rpcs')
+    for endpoint in sorted(report):
+        stats = report[endpoint]
+        print '{:<16} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.2f}'.format(
+            endpoint, stats['calls'], stats['p50_ms'], stats['p90_ms'],
+            stats['p99_ms'], stats['datastore_rpcs'])
+
+
+def main():
+    args = parse_args()
+    perftools.setup_sdk(args.sdk)
+    benchmark = Benchmark(args, random.Random(args.seed))
+    try:
+        benchmark.seed()
+        benchmark.run()
+        report = benchmark.report()
+    finally:
+        benchmark.close()
+
+    print_report(report)
+    perftools.check_baseline(args, report, ('p50_ms', 'p99_ms'),
+                             ('datastore_rpcs',))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""coldstart.py - Measures the cold start of the application modules. Each
+run starts a fresh interpreter with the App Engine testbed stubs, imports a
+module and, for main, serves the warmup request, reporting the import time,
+the time of the first request and the number of modules loaded. The report
+is compared against a baseline recorded with --save-baseline (see
+perftools.py).
+
+Usage:
+    python coldstart.py --sdk PATH_TO_GOOGLE_APPENGINE [--save-baseline]
+
+Exits with status 1 if a module got slower or loads more modules than in the
+baseline."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import perftools
+from perftools import ROOT
+
+# Modules loaded by a new instance, and the path of their first request
+MODULES = [
+    ('main', '/_ah/warmup'),
+    ('api', None),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    perftools.add_arguments(parser, 'coldstart_baseline.json')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Fresh interpreters started for each module')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def measure(module, path):
+    """Imports the module in this interpreter, serves its first request and
+    prints the measures as JSON"""
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+
+    modules = len(sys.modules)
+    start = time.time()
+    imported = __import__(module)
+    stats = {'import_ms': (time.time() - start) * 1000,
+             'modules_loaded': len(sys.modules) - modules}
+    if path:
+        import webapp2
+        start = time.time()
+        webapp2.Request.blank(path).get_response(imported.app)
+        stats['first_request_ms'] = (time.time() - start) * 1000
+    bed.deactivate()
+    print json.dumps(stats)
+
+
+def run(args, module, path):
+    """Returns the median of each measure of a module over args.runs fresh
+    interpreters"""
+    command = [sys.executable, os.path.abspath(__file__), '--child', module]
+    if args.sdk:
+        command += ['--sdk', args.sdk]
+    if path:
+        command += ['--path', path]
+    runs = [json.loads(subprocess.check_output(command).splitlines()[-1])
+            for _ in range(args.runs)]
+    return dict((name, sorted(stats[name] for stats in runs)[len(runs) // 2])
+                for name in runs[0])
+
+
+def print_report(report):
+    """Prints the measures of each module"""
+    print '{:<8} {:>10} {:>17} {:>15}'.format(
+        'module', 'import ms', 'first request ms', 'modules loaded')
+    for module in sorted(report):
+        stats = report[module]
+        print '{:<8} {:>10.2f} {:>17} {:>15}'.format(
+            module, stats['import_ms'],
+            '{:.2f}'.format(stats['first_request_ms'])
+            if 'first_request_ms' in stats else '-',
+            stats['modules_loaded'])
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        perftools.setup_sdk(args.sdk)
+        measure(args.child, args.path)
+        return
+
+    report = dict((module, run(args, module, path))
+                  for module, path in MODULES)
+
+    print_report(report)
+    perftools.check_baseline(args, report,
+                             ('import_ms', 'first_request_ms'),
+                             ('modules_loaded',))
+
+
+if __name__ == '__main__':
+    main()
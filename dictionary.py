@@ -0,0 +1,102 @@
+"""dictionary.py - Server side word list of the Hangman game. The words are
+loaded once per instance from words.txt and kept in tuples sorted by length
+and by difficulty, with the offsets of each bucket, so a random word of a
+given length and/or difficulty is picked in constant time."""
+
+import os
+import random
+import threading
+
+import engine
+
+WORDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'words.txt')
+
+EASY = 'easy'
+MEDIUM = 'medium'
+HARD = 'hard'
+DIFFICULTIES = (EASY, MEDIUM, HARD)
+
+# Letters that players usually try late
+RARE_LETTERS = frozenset('jkqvwxyz')
+
+_dictionary = []
+_lock = threading.Lock()
+
+
+def word_difficulty(word):
+    """Rates how hard a word is to guess. Each distinct letter is one more
+    right guess to make, and rare letters count twice more."""
+    letters = set(word)
+    points = len(letters) + 2 * len(letters & RARE_LETTERS)
+    if points <= 5:
+        return EASY
+    if points <= 8:
+        return MEDIUM
+    return HARD
+
+
+class Dictionary(object):
+    """Words bucketed by length and by difficulty"""
+
+    def __init__(self, words):
+        rated = set((word, DIFFICULTIES.index(word_difficulty(word)))
+                    for word in words if engine.is_valid_word(word))
+
+        by_length = sorted(rated, key=lambda item:
+                           (len(item[0]), item[1], item[0]))
+        self._by_length = tuple(word for word, _ in by_length)
+        self._length_offsets = self._offsets(
+            [len(word) for word, _ in by_length])
+        self._length_difficulty_offsets = self._offsets(
+            [(len(word), DIFFICULTIES[difficulty])
+             for word, difficulty in by_length])
+
+        by_difficulty = sorted(rated, key=lambda item: (item[1], item[0]))
+        self._by_difficulty = tuple(word for word, _ in by_difficulty)
+        self._difficulty_offsets = self._offsets(
+            [DIFFICULTIES[difficulty] for _, difficulty in by_difficulty])
+
+    @staticmethod
+    def _offsets(bucket_keys):
+        """Returns a dict mapping each bucket to its (start, end) offsets in
+        a list sorted by bucket"""
+        offsets = {}
+        for position, bucket in enumerate(bucket_keys):
+            start, _ = offsets.get(bucket, (position, position))
+            offsets[bucket] = (start, position + 1)
+        return offsets
+
+    def __len__(self):
+        return len(self._by_length)
+
+    def random_word(self, length=None, difficulty=None, rng=random):
+        """Returns a random word with the length and difficulty, if given, or
+        None if there is no such word"""
+        if length and difficulty:
+            words = self._by_length
+            start, end = self._length_difficulty_offsets.get(
+                (length, difficulty), (0, 0))
+        elif length:
+            words = self._by_length
+            start, end = self._length_offsets.get(length, (0, 0))
+        elif difficulty:
+            words = self._by_difficulty
+            start, end = self._difficulty_offsets.get(difficulty, (0, 0))
+        else:
+            words = self._by_length
+            start, end = 0, len(words)
+        if start == end:
+            return None
+        return words[rng.randrange(start, end)]
+
+
+def get_dictionary():
+    """Returns the Dictionary of this instance, loading it on first use"""
+    if not _dictionary:
+        with _lock:
+            if not _dictionary:
+                with open(WORDS_FILE) as words_file:
+                    _dictionary.append(Dictionary(
+                        line.strip().lower() for line in words_file))
+    return _dictionary[0]
@@ -0,0 +1,127 @@
+"""engine.py - Datastore free core of the Hangman game. The letters tried and
+the letters still to be guessed are kept as bitmasks (bit 0 is 'a', bit 25 is
+'z'), and the positions of each letter of a word are indexed once, so a guess
+is evaluated with a couple of integer operations instead of string scans."""
+
+import string
+
+LETTERS = string.ascii_lowercase
+
+# Outcomes of a guess
+NOT_A_LETTER = 'not_a_letter'
+NOT_ONE_LETTER = 'not_one_letter'
+ALREADY_TRIED = 'already_tried'
+HIT = 'hit'
+MISS = 'miss'
+WIN = 'win'
+LOSS = 'loss'
+
+# Maximum number of words whose letter positions are kept in memory
+MAX_INDEXED_WORDS = 10000
+
+_letter_positions = {}
+
+
+def letter_bit(letter):
+    """Returns the bit that represents a lowercase letter in a mask"""
+    return 1 << (ord(letter) - ord('a'))
+
+
+def word_mask(word):
+    """Returns the mask with the bits of all the letters of a word"""
+    mask = 0
+    for letter in word:
+        mask |= letter_bit(letter)
+    return mask
+
+
+def is_valid_word(word):
+    """Returns True if the word can be played: only lowercase ASCII letters"""
+    return bool(word) and all(letter in LETTERS for letter in word)
+
+
+def letter_positions(word):
+    """Returns a dict mapping each letter of the word to a tuple with its
+    positions in the word. The index is built once per word and instance."""
+    positions = _letter_positions.get(word)
+    if positions is None:
+        index = {}
+        for pos, letter in enumerate(word):
+            index.setdefault(letter, []).append(pos)
+        positions = dict((letter, tuple(pos_list))
+                         for letter, pos_list in index.iteritems())
+        if len(_letter_positions) >= MAX_INDEXED_WORDS:
+            _letter_positions.clear()
+        _letter_positions[word] = positions
+    return positions
+
+
+class GameState(object):
+    """The mutable state of a game of Hangman"""
+    __slots__ = ('word', 'current_word', 'tried_mask', 'remaining_mask',
+                 'attempts_remaining')
+
+    def __init__(self, word, current_word, tried_mask, remaining_mask,
+                 attempts_remaining):
+        self.word = word
+        self.current_word = current_word
+        self.tried_mask = tried_mask
+        self.remaining_mask = remaining_mask
+        self.attempts_remaining = attempts_remaining
+
+    @classmethod
+    def new(cls, word, attempts):
+        """Returns the state of a new game for the word"""
+        letter_positions(word)
+        return cls(word, len(word) * " ", 0, word_mask(word), attempts)
+
+    @classmethod
+    def from_letters_tried(cls, word, current_word, letters_tried,
+                           attempts_remaining):
+        """Returns the state of a game stored before the masks existed"""
+        tried_mask = word_mask(letters_tried)
+        return cls(word, current_word, tried_mask,
+                   word_mask(word) & ~tried_mask, attempts_remaining)
+
+    @property
+    def word_remaining(self):
+        """The letters of the word that were not guessed yet"""
+        return ''.join(letter for letter in self.word
+                       if self.remaining_mask & letter_bit(letter))
+
+    def check(self, guess):
+        """Returns the outcome that makes the guess invalid, or None if it
+        can be played"""
+        if len(guess) != 1:
+            if guess.isalpha():
+                return NOT_ONE_LETTER
+            return NOT_A_LETTER
+        if guess not in LETTERS:
+            return NOT_A_LETTER
+        if self.tried_mask & letter_bit(guess):
+            return ALREADY_TRIED
+        return None
+
+    def guess(self, guess):
+        """Plays a lowercase letter and returns the outcome of the guess"""
+        outcome = self.check(guess)
+        if outcome:
+            return outcome
+
+        bit = letter_bit(guess)
+        self.tried_mask |= bit
+        if self.remaining_mask & bit:
+            current_word = list(self.current_word)
+            for position in letter_positions(self.word)[guess]:
+                current_word[position] = guess
+            self.current_word = ''.join(current_word)
+            self.remaining_mask &= ~bit
+            if not self.remaining_mask:
+                return WIN
+            return HIT
+
+        # An attempt is only deduced if the guess is wrong
+        self.attempts_remaining -= 1
+        if self.attempts_remaining < 1:
+            return LOSS
+        return MISS
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""export.py - Export of the Score and Game entities to chunked CSV files for
+offline analytics. Entities are streamed with paged keys-only queries and
+batch gets, so the export never holds a whole kind in memory, and the chunks
+are written through a sink, so the destination can be swapped.
+
+Usage, against a deployed application through remote_api:
+    python export.py --sdk PATH_TO_GOOGLE_APPENGINE --app-id APP_ID \\
+        --out DIRECTORY
+
+The files are read by analytics.py."""
+
+import argparse
+import csv
+import os
+import sys
+
+EXPORT_BATCH_SIZE = 500
+# Number of rows written to each file
+CHUNK_ROWS = 50000
+
+SCORE_COLUMNS = ('user_id', 'user_name', 'date', 'won', 'guesses', 'score',
+                 'word_to_guess')
+GAME_COLUMNS = ('game_id', 'user_id', 'word_to_guess', 'attempts_allowed',
+                'attempts_remaining', 'guesses', 'game_over', 'cancelled')
+
+
+class LocalFileSink(object):
+    """Sink writing the chunks to files in a local directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, name):
+        """Returns a new file object for the chunk with the name"""
+        return open(os.path.join(self.directory, name), 'wb')
+
+
+class ChunkedCsvWriter(object):
+    """Writes rows to numbered CSV chunks of at most CHUNK_ROWS rows, each
+    with a header line"""
+
+    def __init__(self, sink, prefix, columns, chunk_rows=CHUNK_ROWS):
+        self.sink = sink
+        self.prefix = prefix
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.chunks = 0
+        self.rows = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, row):
+        if self._file is None or self.rows % self.chunk_rows == 0:
+            self._next_chunk()
+        self._writer.writerow([_encode(row[column])
+                               for column in self.columns])
+        self.rows += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _next_chunk(self):
+        self.close()
+        self._file = self.sink.open('{}-{:05d}.csv'.format(self.prefix,
+                                                           self.chunks))
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.columns)
+        self.chunks += 1
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def iter_batches(model, batch_size=EXPORT_BATCH_SIZE):
+    """Yields the entities of a kind in lists of batch_size, fetched with a
+    keys-only page followed by a batch get"""
+    from google.appengine.ext import ndb
+    cursor = None
+    more = True
+    while more:
+        keys, cursor, more = model.query().fetch_page(
+            batch_size, start_cursor=cursor, keys_only=True)
+        entities = [entity for entity in ndb.get_multi(keys) if entity]
+        if entities:
+            yield entities
+
+
+def score_rows(scores):
+    """Returns the rows of a batch of Scores"""
+    from models import get_user_names
+    user_names = get_user_names([score.user for score in scores])
+    return [{'user_id': score.user.id(),
+             'user_name': user_names.get(score.user, ''),
+             'date': score.date.isoformat(),
+             'won': int(score.won),
+             'guesses': score.guesses,
+             'score': score.score,
+             'word_to_guess': score.get_word()} for score in scores]
+
+
+def game_rows(games):
+    """Returns the rows of a batch of Games"""
+    return [{'game_id': game.key.id(),
+             'user_id': game.user.id(),
+             'word_to_guess': game.get_word(),
+             'attempts_allowed': game.attempts_allowed,
+             'attempts_remaining': game.attempts_remaining,
+             'guesses': len(game.letters_tried),
+             'game_over': int(game.game_over),
+             'cancelled': int(game.cancelled)} for game in games]
+
+
+def export(sink):
+    """Exports the Scores and Games through the sink. Returns a dict with the
+    number of rows written for each kind."""
+    from models import Score, Game
+    counts = {}
+    for prefix, model, columns, to_rows in (
+            ('scores', Score, SCORE_COLUMNS, score_rows),
+            ('games', Game, GAME_COLUMNS, game_rows)):
+        writer = ChunkedCsvWriter(sink, prefix, columns)
+        try:
+            for entities in iter_batches(model):
+                for row in to_rows(entities):
+                    writer.write(row)
+        finally:
+            writer.close()
+        counts[prefix] = writer.rows
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path of the google_appengine SDK directory')
+    parser.add_argument('--app-id', required=True)
+    parser.add_argument('--out', required=True,
+                        help='Directory the CSV chunks are written to')
+    args = parser.parse_args()
+
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(
+        '{}.appspot.com'.format(args.app_id), '/_ah/remote_api')
+
+    for prefix, rows in sorted(export(LocalFileSink(args.out)).items()):
+        print '{}: {} rows'.format(prefix, rows)
+
+
+if __name__ == '__main__':
+    main()
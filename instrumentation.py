@@ -0,0 +1,121 @@
+"""instrumentation.py - Per request instrumentation of the API endpoints. The
+instrumented decorator measures the wall time of an endpoint call and counts
+the App Engine RPCs it makes (ndb issues its datastore and memcache calls
+through the same apiproxy, so they are counted too). Each call is logged as a
+structured JSON line and added to counters aggregated in memcache."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+STATS_PREFIX = 'ENDPOINT_STATS:'
+# Number of calls recorded on an instance before they are added to memcache
+STATS_FLUSH = 20
+
+METRICS = ('calls', 'wall_ms', 'datastore_gets', 'datastore_puts',
+           'datastore_queries', 'memcache_lookups', 'memcache_hits',
+           'taskqueue_adds', 'ratelimit_us', 'throttled', 'coalesced_reads',
+           'guess_conflicts', 'guess_retries')
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending = defaultdict(int)
+_pending_calls = [0]
+_endpoints = []
+
+
+def instrumented(func):
+    """Decorator of HangmanApi methods, placed under @endpoints.method"""
+    _endpoints.append(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(service, request):
+        stats = defaultdict(int)
+        _local.stats = stats
+        start = time.time()
+        try:
+            return func(service, request)
+        finally:
+            _local.stats = None
+            stats['calls'] = 1
+            stats['wall_ms'] = int(round((time.time() - start) * 1000))
+            logging.info('endpoint_stats %s',
+                         json.dumps(dict(stats, endpoint=func.__name__),
+                                    sort_keys=True))
+            _record(func.__name__, stats)
+    return wrapper
+
+
+def add_stat(metric, value=1):
+    """Adds a value to a metric of the current endpoint call, if any"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[metric] += value
+
+
+def get_endpoint_stats():
+    """Returns a dict mapping each instrumented endpoint to the dict of its
+    aggregated METRICS"""
+    _flush()
+    keys = [STATS_PREFIX + endpoint + ':' + metric
+            for endpoint in _endpoints for metric in METRICS]
+    values = memcache.get_multi(keys)
+    return dict((endpoint, dict((metric, values.get(
+                    STATS_PREFIX + endpoint + ':' + metric, 0))
+                    for metric in METRICS))
+                for endpoint in _endpoints)
+
+
+def _count_rpc(service, call, request, response):
+    """apiproxy post-call hook counting the RPCs of the current call"""
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    if service == 'datastore_v3':
+        if call == 'Get':
+            stats['datastore_gets'] += 1
+        elif call == 'Put':
+            stats['datastore_puts'] += 1
+        elif call in ('RunQuery', 'Next'):
+            stats['datastore_queries'] += 1
+    elif service == 'memcache' and call == 'Get':
+        stats['memcache_lookups'] += request.key_size()
+        stats['memcache_hits'] += response.item_size()
+    elif service == 'taskqueue':
+        if call == 'Add':
+            stats['taskqueue_adds'] += 1
+        elif call == 'BulkAdd':
+            stats['taskqueue_adds'] += request.add_request_size()
+
+
+def _record(endpoint, stats):
+    """Adds the stats of a call to the counters of this instance, which are
+    added to memcache every STATS_FLUSH calls"""
+    with _lock:
+        for metric, value in stats.items():
+            _pending[STATS_PREFIX + endpoint + ':' + metric] += value
+        _pending_calls[0] += 1
+        flush = _pending_calls[0] >= STATS_FLUSH
+    if flush:
+        _flush()
+
+
+def _flush():
+    """Adds the counters of this instance to the counters in memcache"""
+    with _lock:
+        offsets = dict((key, value) for key, value in _pending.items()
+                       if value)
+        _pending.clear()
+        _pending_calls[0] = 0
+    if offsets:
+        memcache.offset_multi(offsets, initial_value=0)
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _count_rpc)
@@ -1,29 +1,79 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by taskqueue and/or
-cronjobs."""
+cronjobs, and the warmup handler. It does not import the endpoints stack, and
+the APIs only used by some handlers are imported by them, so a cold instance
+serving a task loads as little as possible."""
+
+import importlib
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangmanApi
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import User, UserName, Game, Score, ActiveGamesShard,\
+    WordStatsShard, UserResultsShard, Leaderboard, GameArchive,\
+    GameEndCounters
+from models import normalize_user_name
+
+BACKFILL_BATCH_SIZE = 50
+REMINDER_BATCH_SIZE = 100
+LEADERBOARD_RETENTION_DAYS = 30
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 100
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the endpoints module and the dictionary, and open the
+        datastore and memcache connections, before the instance serves
+        traffic. Called by App Engine when it starts an instance."""
+        importlib.import_module('api')
+        from dictionary import get_dictionary
+        get_dictionary()
+        ndb.get_multi([ndb.Key(ActiveGamesShard, '0'),
+                       ndb.Key(UserName, '_warmup')], use_cache=False)
+        memcache.get(ActiveGamesShard.MEMCACHE_AVERAGE_ATTEMPTS)
+        self.response.set_status(204)
 
-from models import User, Game
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Start sending a reminder email to each User with an active game.
+        Called every hour using a cron job. The Users are reminded in batches
+        by SendReminderBatch tasks."""
+        _enqueue_reminder_batch(time.strftime('%Y%m%d%H'), 0)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send a reminder email to one batch of the Users with a game that
+        is not over and is not cancelled. The task of the next batch is
+        chained before sending, so batches run in parallel, and the cursor
+        of the batch is its checkpoint if the task is retried."""
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        page_token = self.request.get('cursor')
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+
+        # The distinct projection returns each User with active games once
+        games, next_cursor, more = Game.query(
+            Game.game_over == False, Game.cancelled == False,
+            projection=[Game.user], distinct=True).fetch_page(
+                REMINDER_BATCH_SIZE, start_cursor=cursor)
+        if more and next_cursor:
+            _enqueue_reminder_batch(run, batch + 1, next_cursor.urlsafe())
+
+        from google.appengine.api import app_identity, mail
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        users = ndb.get_multi([game.user for game in games])
         for user in users:
-            user_games = Game.query(Game.user == user.key)
-            send_email = False
-            for game in user_games:
-                # If there is a game that is not over and is not cancelled, set
-                # the user to be reminded
-                if game.game_over == False and game.cancelled == False:
-                    send_email = True
-            if send_email == True:
+            if user and user.email:
                 subject = 'This is a reminder!'
                 body = 'Hello {}, go back to your Hangman game!'.format(user.name)
                 # This will send test emails, the arguments to send_mail are:
@@ -32,15 +82,254 @@ class SendReminderEmail(webapp2.RequestHandler):
                                user.email,
                                subject,
                                body)
+        self.response.set_status(204)
+
+
+def _enqueue_reminder_batch(run, batch, cursor=None):
+    """Enqueues the task of a batch of reminders. Tasks are named after the
+    run and the batch, so a retried task does not chain a batch twice."""
+    params = {'run': run, 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add(url='/tasks/send_reminder_batch',
+                      name='send-reminder-{}-{}'.format(run, batch),
+                      params=params)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
         """Update game listing announcement in memcache."""
-        HangmanApi._cache_average_attempts()
+        ActiveGamesShard.cache_average_attempts()
+        self.response.set_status(204)
+
+
+class BackfillUserAggregates(webapp2.RequestHandler):
+    def post(self):
+        """Recompute the ranking and profile aggregates of a batch of Users
+        from their Scores and chain a task for the next batch. Run once to
+        initialize the aggregates of Users created before they existed."""
+        page_token = self.request.get('cursor')
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        user_keys, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for user_key in user_keys:
+            _rebuild_user_aggregates(
+                user_key, Score.query(Score.user == user_key).fetch())
+        memcache.delete_multi([User.PROFILE_PREFIX + str(user_key.id())
+                               for user_key in user_keys])
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_aggregates',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+@ndb.transactional(xg=True)
+def _rebuild_user_aggregates(user_key, scores):
+    """Overwrite all the aggregates of a User with those of its Scores and
+    delete its pending results, which the Scores already count"""
+    entities = ndb.get_multi([user_key] +
+                             UserResultsShard.shard_keys(user_key))
+    user = entities[0]
+    if not user:
+        return
+    user.games_played = user.wins = user.score_count = user.current_streak = 0
+    user.score_sum = user.average_score = user.best_score = 0.0
+    # Scores only carry a date, so games finished on the same day as the
+    # last loss may be counted in either order
+    for score in sorted(scores, key=lambda score: score.date):
+        user.record_result(score.won, score.score)
+    user.put()
+    ndb.delete_multi([shard.key for shard in entities[1:] if shard])
+
+
+class BackfillUserNames(webapp2.RequestHandler):
+    def post(self):
+        """Create the UserName index entity of a batch of Users and chain a
+        task for the next batch. Required once, before serving traffic, to
+        index the Users created before the index existed: names are only
+        resolved through it."""
+        page_token = self.request.get('cursor')
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        users, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        for user in users:
+            index = UserName.get_or_insert(normalize_user_name(user.name),
+                                           user=user.key)
+            if index.user != user.key:
+                logging.warning('User %s has the same name as User %s',
+                                user.key.id(), index.user.id())
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_names',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class BackfillWordStats(webapp2.RequestHandler):
+    def post(self):
+        """Add a batch of the Scores dated before the 'before' parameter
+        (YYYY-MM-DD) to the statistics of their words and chain a task for
+        the next batch. Run once, with the date the statistics started to be
+        kept, to count the games finished before."""
+        before = datetime.strptime(self.request.get('before'),
+                                   '%Y-%m-%d').date()
+        page_token = self.request.get('cursor')
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        scores, next_cursor, more = Score.query(
+            Score.date < before).fetch_page(BACKFILL_BATCH_SIZE,
+                                            start_cursor=cursor)
+        plays = defaultdict(int)
+        wins = defaultdict(int)
+        for score in scores:
+            # The games of events are not counted
+            if score.puzzle:
+                continue
+            plays[score.word_to_guess] += 1
+            if score.won:
+                wins[score.word_to_guess] += 1
+        for word in plays:
+            WordStatsShard.increment_async(word, plays[word],
+                                           wins[word]).get_result()
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_word_stats',
+                          params={'before': self.request.get('before'),
+                                  'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class BackfillGameUpdated(webapp2.RequestHandler):
+    def post(self):
+        """Write again the finished or cancelled games of a batch stored
+        before Game.updated existed, which sets it, and chain a task for the
+        next batch. Run once so the archive cron, which filters on updated,
+        finds them ARCHIVE_AFTER_DAYS days later."""
+        status = self.request.get('status')
+        page_token = self.request.get('cursor')
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        games, next_cursor, more = Game.query(
+            getattr(Game, status) == True).fetch_page(BACKFILL_BATCH_SIZE,
+                                                     start_cursor=cursor)
+        ndb.put_multi([game for game in games if game.updated is None])
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_game_updated',
+                          params={'status': status,
+                                  'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RebuildActiveGamesCounter(webapp2.RequestHandler):
+    def post(self):
+        """Recount the active games and the sum of their attempts remaining.
+        Run once to initialize the counter with the games created before it
+        existed."""
+        count = 0
+        total_attempts_remaining = 0
+        for game in Game.query(Game.game_over == False,
+                               Game.cancelled == False):
+            count += 1
+            total_attempts_remaining += game.attempts_remaining
+        ActiveGamesShard.reset(count, total_attempts_remaining)
+        ActiveGamesShard.cache_average_attempts()
+        self.response.set_status(204)
+
+
+class FoldUserResults(webapp2.RequestHandler):
+    def post(self):
+        """Add the results of the games a User ended to its aggregates.
+        Enqueued once the transaction that ends a game commits."""
+        user_key = ndb.Key(urlsafe=self.request.get('user'))
+        UserResultsShard.fold(user_key)
+        self.response.set_status(204)
+
+
+class RecordGameEnd(webapp2.RequestHandler):
+    def post(self):
+        """Add a finished game to the shared counters. Enqueued by the
+        transaction that ends the game."""
+        Game.record_end(json.loads(self.request.body))
+        self.response.set_status(204)
+
+
+class RecordHighScore(webapp2.RequestHandler):
+    def post(self):
+        """Record the Score of a finished game on the leaderboards of its day,
+        week and all time. Enqueued by the transaction that ends the game."""
+        Leaderboard.record(json.loads(self.request.body))
+        self.response.set_status(204)
+
+
+class RolloverLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Create the leaderboards of the new day and week and delete the old
+        day leaderboards. Called every day using a cron job."""
+        Leaderboard.rollover(LEADERBOARD_RETENTION_DAYS)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start moving the games finished or cancelled more than
+        ARCHIVE_AFTER_DAYS days ago to the GameArchive kind. Called every day
+        using a cron job."""
+        cutoff = (datetime.utcnow() -
+                  timedelta(days=ARCHIVE_AFTER_DAYS)).strftime(
+                      '%Y-%m-%dT%H:%M:%S')
+        for status in ('game_over', 'cancelled'):
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'status': status, 'cutoff': cutoff})
+
+
+class ArchiveGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Archive one batch of the games with the 'status' property set that
+        were last written before 'cutoff', and chain a task for the next
+        batch. Finished games never change, so each archive is written before
+        its game is deleted and a retried batch only writes it again."""
+        start = time.time()
+        status = self.request.get('status')
+        cutoff = datetime.strptime(self.request.get('cutoff'),
+                                   '%Y-%m-%dT%H:%M:%S')
+        page_token = self.request.get('cursor')
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        keys, next_cursor, more = Game.query(
+            getattr(Game, status) == True, Game.updated < cutoff).fetch_page(
+                ARCHIVE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        games = [game for game in ndb.get_multi(keys) if game]
+        ndb.put_multi([GameArchive.from_game(game) for game in games])
+        ndb.delete_multi([game.key for game in games] +
+                         [ndb.Key(GameEndCounters, game.key.urlsafe())
+                          for game in games])
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'status': status,
+                                  'cutoff': self.request.get('cutoff'),
+                                  'cursor': next_cursor.urlsafe()})
+
+        elapsed = time.time() - start
+        logging.info('archive_stats %s', json.dumps({
+            'status': status,
+            'games': len(games),
+            'seconds': round(elapsed, 3),
+            'games_per_second': round(len(games) / elapsed, 1) if elapsed
+                                else 0.0}, sort_keys=True))
         self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder_batch', SendReminderBatch),
+    ('/tasks/record_high_score', RecordHighScore),
+    ('/tasks/record_game_end', RecordGameEnd),
+    ('/tasks/fold_user_results', FoldUserResults),
+    ('/crons/rollover_leaderboards', RolloverLeaderboards),
+    ('/crons/archive_games', ArchiveGames),
+    ('/tasks/archive_games', ArchiveGamesBatch),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/backfill_user_aggregates', BackfillUserAggregates),
+    ('/tasks/rebuild_active_games_counter', RebuildActiveGamesCounter),
+    ('/tasks/backfill_user_names', BackfillUserNames),
+    ('/tasks/backfill_word_stats', BackfillWordStats),
+    ('/tasks/backfill_game_updated', BackfillGameUpdated),
 ], debug=True)
@@ -1,11 +1,23 @@
 """Models for the Hangman game"""
 from __future__ import division
 
+import heapq
+import json
 import random
-from datetime import date
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+import engine
+
+# Compare-and-set attempts of a versioned cache write before it gives up
+CAS_RETRIES = 3
+
 def calcWinningPercentage(games_played, wins):
     """Formula for calculation of Winning Percentage, to be used as a Computed
     Property on the User Model"""
@@ -17,6 +29,68 @@ def calcWinningPercentage(games_played, wins):
     return winning_percentage
 
 
+def normalize_user_name(name):
+    """Returns the form of a user name used to enforce unique names"""
+    return name.strip().lower()
+
+
+class LruCache(object):
+    """Small thread safe least recently used cache, kept per instance"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+def cas_write_versioned(key, version, value, time):
+    """Writes (version,) + value to memcache with a compare-and-set that
+    never replaces a newer version. The entry is deleted if the
+    compare-and-set keeps failing."""
+    client = memcache.Client()
+    value = (version,) + tuple(value)
+    for _ in range(CAS_RETRIES):
+        cached = client.gets(key)
+        if cached is None:
+            if client.add(key, value, time=time):
+                return
+        elif cached[0] >= version:
+            return
+        elif client.cas(key, value, time=time):
+            return
+    client.delete(key)
+
+
+def get_user_names(user_keys):
+    """Resolves the names of the given User keys with a single batch get, so
+    serializing a list of Scores or Games does not fetch each owner serially.
+    Returns a dict mapping each User key to its name."""
+    keys = list(set(user_keys))
+    users = ndb.get_multi(keys)
+    return dict((key, user.name) for key, user in zip(keys, users) if user)
+
+
+class UserName(ndb.Model):
+    """Index of the Users keyed by their normalized name. It is created in the
+    same transaction as its User, so two Users cannot share a name, and a
+    name is resolved with a strongly consistent get instead of a query."""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
 class User(ndb.Model):
     """User profile"""
     name = ndb.StringProperty(required=True)
@@ -26,77 +100,651 @@ class User(ndb.Model):
     winning_percentage = ndb.ComputedProperty(lambda self:
                             calcWinningPercentage(self.games_played, self.wins))
     average_score = ndb.FloatProperty(required=True, default=0.0)
+    score_sum = ndb.FloatProperty(required=True, default=0.0)
+    score_count = ndb.IntegerProperty(required=True, default=0)
+    best_score = ndb.FloatProperty(required=True, default=0.0, indexed=False)
+    # Number of games won in a row, up to the last finished game
+    current_streak = ndb.IntegerProperty(required=True, default=0,
+                                         indexed=False)
+
+    # Per instance cache of the User keys by normalized name
+    _keys_by_name = LruCache(10000)
+
+    PROFILE_PREFIX = 'USER_PROFILE:'
+    PROFILE_CACHE_TIME = 3600
+
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates and returns a User, or returns None if the name is already
+        taken. The User and its UserName are written in one transaction."""
+        if cls.get_key_by_name(name):
+            return None
+        user = cls(id=cls.allocate_ids(1)[0], name=name, email=email,
+                   games_played=0, wins=0, average_score=0.0)
+
+        @ndb.transactional(xg=True)
+        def _create():
+            index_key = ndb.Key(UserName, normalize_user_name(name))
+            if index_key.get():
+                return None
+            ndb.put_multi([user, UserName(key=index_key, user=user.key)])
+            return user
+        return _create()
+
+    @classmethod
+    def get_key_by_name(cls, name):
+        """Returns the key of the User with the name, or None. Users created
+        before the UserName index existed are only found once
+        /tasks/backfill_user_names has indexed them."""
+        normalized_name = normalize_user_name(name or '')
+        if not normalized_name:
+            return None
+        key = cls._keys_by_name.get(normalized_name)
+        if key:
+            return key
+        index = UserName.get_by_id(normalized_name)
+        if not index:
+            return None
+        cls._keys_by_name.set(normalized_name, index.user)
+        return index.user
+
+    @classmethod
+    def get_keys_by_names(cls, names):
+        """Returns a dict mapping each of the names that exist to the key of
+        its User. The UserName entities not cached on this instance are read
+        with a single batch get."""
+        keys = {}
+        missing = []
+        for name in set(names):
+            key = cls._keys_by_name.get(normalize_user_name(name or ''))
+            if key:
+                keys[name] = key
+            elif normalize_user_name(name or ''):
+                missing.append(name)
+        indexes = ndb.get_multi([ndb.Key(UserName, normalize_user_name(name))
+                                 for name in missing])
+        for name, index in zip(missing, indexes):
+            if index:
+                cls._keys_by_name.set(normalize_user_name(name), index.user)
+                keys[name] = index.user
+        return keys
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the name, or None"""
+        key = cls.get_key_by_name(name)
+        return key.get() if key else None
+
+    def record_result(self, won, score):
+        """Update the ranking aggregates of the User with the result of a
+        finished game. Must be called inside the transaction that folds the
+        result into the User, so the running sums never miss or double count
+        a Score."""
+        self.games_played += 1
+        if won:
+            self.wins += 1
+        self.score_sum += score
+        self.score_count += 1
+        self.average_score = self.score_sum / self.score_count
+        self.best_score = max(self.best_score, score)
+        self.current_streak = self.current_streak + 1 if won else 0
+
+    @classmethod
+    def get_profile(cls, key):
+        """Returns the UserProfileForm of the User with the key, or None if
+        there is no such User. A miss is read from the datastore and added
+        to the profile cache."""
+        cached = memcache.get(cls.PROFILE_PREFIX + str(key.id()))
+        if cached is not None:
+            return UserProfileForm(**cached[1])
+        user = key.get()
+        if not user:
+            return None
+        form = user.to_profile_form()
+        memcache.add(cls.PROFILE_PREFIX + str(key.id()),
+                     (user.games_played, cls._profile_fields(form)),
+                     time=cls.PROFILE_CACHE_TIME)
+        return form
+
+    def cache_profile(self):
+        """Writes the profile of the User through to the profile cache,
+        versioned by games_played. Call once the aggregates are committed."""
+        cas_write_versioned(self.PROFILE_PREFIX + str(self.key.id()),
+                            self.games_played,
+                            (self._profile_fields(self.to_profile_form()),),
+                            self.PROFILE_CACHE_TIME)
+
+    @staticmethod
+    def _profile_fields(form):
+        return dict((field.name, form.get_assigned_value(field.name))
+                    for field in form.all_fields())
+
+    def to_profile_form(self):
+        """Returns UserProfileForm representation of the User"""
+        return UserProfileForm(user_name=self.name,
+                               games_played=self.games_played,
+                               wins=self.wins,
+                               winning_percentage=self.winning_percentage,
+                               score_sum=self.score_sum,
+                               score_count=self.score_count,
+                               average_score=self.average_score,
+                               best_score=self.best_score,
+                               current_streak=self.current_streak)
+
+    def to_ranking_form(self):
+        """Returns RankingForm representation of the User"""
+        return RankingForm(user_name=self.name,
+                           winning_percentage=self.winning_percentage,
+                           average_score=self.average_score)
+
+
+class UserResultsShard(ndb.Model):
+    """Shard of the results of the games a User finished that are not yet
+    added to the aggregates of the User. A game ends on a random shard, so
+    the games of a popular account do not serialize on the User entity group,
+    and a task periodically folds the shards into the User, in the order the
+    games ended."""
+    # List of the [time, won, score] of the results
+    results = ndb.JsonProperty(indexed=False)
+
+    NUM_SHARDS = 10
+    # Seconds covered by each named task that folds the results of a User
+    FOLD_PERIOD = 5
+
+    @classmethod
+    def shard_keys(cls, user_key):
+        return [ndb.Key(cls, '{}:{}'.format(user_key.id(), i))
+                for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True,
+                               propagation=ndb.TransactionOptions.ALLOWED)
+    def add_async(cls, user_key, won, score):
+        """Adds a result to a random shard of the User. Joins the transaction
+        of the caller, and the fold task is enqueued once it commits."""
+        key = random.choice(cls.shard_keys(user_key))
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key, results=[])
+        shard.results = shard.results + [[time.time(), bool(won), score]]
+        yield shard.put_async()
+        ndb.get_context().call_on_commit(
+            lambda: cls.enqueue_fold(user_key))
+
+    @classmethod
+    def enqueue_fold(cls, user_key):
+        """Enqueues the task that folds the results of a User. Tasks are
+        named after the User and a period of FOLD_PERIOD seconds, and run
+        once it is over, so the games a User ends in a period are folded by
+        one task."""
+        now = time.time()
+        period = int(now // cls.FOLD_PERIOD)
+        try:
+            taskqueue.add(url='/tasks/fold_user_results',
+                          name='fold-user-results-{}-{}'.format(
+                              user_key.id(), period),
+                          params={'user': user_key.urlsafe()},
+                          countdown=(period + 1) * cls.FOLD_PERIOD - now + 1)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def fold(cls, user_key):
+        """Adds the results of all the shards of a User to its aggregates,
+        sorted by the time the games ended, and deletes the shards, in one
+        cross-group transaction. Returns the number of results folded."""
+        @ndb.transactional(xg=True)
+        def _fold():
+            entities = ndb.get_multi([user_key] + cls.shard_keys(user_key))
+            user = entities[0]
+            shards = [shard for shard in entities[1:] if shard]
+            if not user or not shards:
+                return 0
+            results = sorted(result for shard in shards
+                             for result in shard.results)
+            for _, won, score in results:
+                user.record_result(won, score)
+            ndb.get_context().call_on_commit(user.cache_profile)
+            futures = [user.put_async()] + ndb.delete_multi_async(
+                [shard.key for shard in shards])
+            for future in futures:
+                future.get_result()
+            return len(results)
+        return _fold()
+
+
+class ActiveGamesShard(ndb.Model):
+    """Shard of the counters of active games and of the sum of their attempts
+    remaining. Writes go to a random shard, so creating and playing games
+    does not serialize on a single entity group."""
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(required=True, default=0,
+                                             indexed=False)
+
+    NUM_SHARDS = 20
+    MEMCACHE_AVERAGE_ATTEMPTS = 'MOVES_REMAINING'
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True,
+                               propagation=ndb.TransactionOptions.ALLOWED)
+    def increment_async(cls, games, attempts_remaining):
+        """Adds the deltas to a random shard. Joins the transaction of the
+        caller, which must not increment the counter twice."""
+        key = ndb.Key(cls, str(random.randint(0, cls.NUM_SHARDS - 1)))
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key)
+        shard.games += games
+        shard.attempts_remaining += attempts_remaining
+        yield shard.put_async()
+
+    @classmethod
+    def totals(cls):
+        """Returns a tuple with the number of active games and the sum of
+        their attempts remaining"""
+        keys = [ndb.Key(cls, str(i)) for i in range(cls.NUM_SHARDS)]
+        shards = [shard for shard in ndb.get_multi(keys) if shard]
+        return (sum([shard.games for shard in shards]),
+                sum([shard.attempts_remaining for shard in shards]))
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def reset(cls, games, attempts_remaining):
+        """Overwrites the counters with totals computed elsewhere"""
+        shards = [cls(id=str(i)) for i in range(cls.NUM_SHARDS)]
+        shards[0].games = games
+        shards[0].attempts_remaining = attempts_remaining
+        ndb.put_multi(shards)
+
+    @classmethod
+    def cache_average_attempts(cls):
+        """Populates memcache with the average moves remaining of active
+        Games, read from the shards. Returns the cached message, which is
+        empty if there are no active games."""
+        count, total_attempts_remaining = cls.totals()
+        message = ''
+        if count > 0:
+            average = float(total_attempts_remaining)/count
+            message = 'The average moves remaining is {:.2f}'.format(average)
+        memcache.set(cls.MEMCACHE_AVERAGE_ATTEMPTS, message)
+        return message
+
+
+class WordStatsShard(ndb.Model):
+    """Shard of the number of finished games and wins of a word. Popular
+    words are played by many users at once, so their counters are spread
+    over NUM_SHARDS entity groups."""
+    word = ndb.StringProperty(required=True, indexed=False)
+    plays = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    NUM_SHARDS = 5
+
+    @classmethod
+    def shard_keys(cls, word):
+        return [ndb.Key(cls, '{}:{}'.format(word, i))
+                for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True,
+                               propagation=ndb.TransactionOptions.ALLOWED)
+    def increment_async(cls, word, plays, wins):
+        """Adds the deltas to a random shard of the word. Joins the
+        transaction of the caller."""
+        key = random.choice(cls.shard_keys(word))
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key, word=word)
+        shard.plays += plays
+        shard.wins += wins
+        yield shard.put_async()
+
+    @classmethod
+    def totals(cls, word):
+        """Returns a tuple with the number of finished games and wins of the
+        word"""
+        shards = [shard for shard in ndb.get_multi(cls.shard_keys(word))
+                  if shard]
+        return (sum([shard.plays for shard in shards]),
+                sum([shard.wins for shard in shards]))
+
+
+# Messages returned for each outcome of a guess
+GUESS_MESSAGES = {
+    engine.NOT_A_LETTER: 'Your guess must be a letter.',
+    engine.NOT_ONE_LETTER: 'Your guess must be one letter only.',
+    engine.ALREADY_TRIED: 'This letter was already tried.',
+    engine.HIT: 'This letter is in the word. You can continue guessing.',
+    engine.WIN: 'You win!',
+    engine.MISS: 'This letter is not in the word to be guessed!',
+    engine.LOSS: 'This letter is not in the word to be guessed! Game over!',
+}
+
+# One character codes of the outcomes stored in the history of a Game
+HISTORY_CODES = {
+    engine.HIT: 'h',
+    engine.MISS: 'm',
+    engine.WIN: 'w',
+    engine.LOSS: 'l',
+}
+HISTORY_MESSAGES = dict((code, GUESS_MESSAGES[outcome])
+                        for outcome, code in HISTORY_CODES.items())
+HISTORY_CODES_BY_MESSAGE = dict((message, code)
+                                for code, message in HISTORY_MESSAGES.items())
 
 
 class Game(ndb.Model):
-    """Game object"""
-    word_to_guess = ndb.StringProperty(required=True)
-    word_remaining = ndb.StringProperty(required=True)
-    current_word = ndb.StringProperty(required=True)
-    attempts_allowed = ndb.IntegerProperty(required=True)
-    attempts_remaining = ndb.IntegerProperty(required=True, default=6)
-    letters_tried = ndb.StringProperty(required=True)
+    """Game object. Only the properties used in queries are indexed. The
+    history of the game is stored compactly: the guesses are letters_tried
+    and each guess has a one character code in history_codes, which is only
+    turned into a message when the game is serialized."""
+    # Empty for the games of an event, which read the word of their Puzzle
+    word_to_guess = ndb.StringProperty(indexed=False)
+    puzzle = ndb.KeyProperty(kind='Puzzle', indexed=False)
+    current_word = ndb.StringProperty(required=True, indexed=False)
+    attempts_allowed = ndb.IntegerProperty(required=True, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(required=True, default=6,
+                                             indexed=False)
+    letters_tried = ndb.StringProperty(required=True, indexed=False)
+    tried_mask = ndb.IntegerProperty(indexed=False)
+    remaining_mask = ndb.IntegerProperty(indexed=False)
+    history_codes = ndb.StringProperty(indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     cancelled = ndb.BooleanProperty(required=True, default=False)
-    guesses = ndb.StringProperty(repeated=True)
-    messages_history = ndb.StringProperty(repeated=True)
     user = ndb.KeyProperty(required=True, kind='User')
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    # Properties of the games stored before history_codes existed. They are
+    # emptied the next time the game is written.
+    word_remaining = ndb.StringProperty(indexed=False)
+    guesses = ndb.StringProperty(repeated=True, indexed=False)
+    messages_history = ndb.StringProperty(repeated=True, indexed=False)
+
+    def _pre_put_hook(self):
+        """Every write of the game increases its version, which orders the
+        states written to the game state cache"""
+        self._migrate_history()
+        self.version += 1
+
+    def _migrate_history(self):
+        """Moves the history of a game stored before history_codes existed
+        to the compact properties"""
+        if self.history_codes is None:
+            self.history_codes = ''.join(
+                HISTORY_CODES_BY_MESSAGE.get(message, '?')
+                for message in self.messages_history)
+            self.word_remaining = None
+            self.guesses = []
+            self.messages_history = []
+
+    def history(self):
+        """Returns the list of (guess, message) tuples of the game"""
+        if self.history_codes is None:
+            return zip(self.guesses, self.messages_history)
+        return [(guess, HISTORY_MESSAGES.get(code, ''))
+                for guess, code in zip(self.letters_tried,
+                                       self.history_codes)]
 
     @classmethod
     def new_game(cls, user, word_to_guess, attempts):
         """Creates and returns a new game"""
-        game = Game(user=user,
-                    word_to_guess=word_to_guess.lower(),
-                    word_remaining=word_to_guess.lower(),
-                    current_word=len(word_to_guess) * " ",
-                    attempts_allowed=attempts,
-                    attempts_remaining=attempts,
-                    letters_tried="",
-                    game_over=False,
-                    cancelled=False)
-        game.put()
+        game = cls.build(user, word_to_guess, attempts)
+
+        @ndb.transactional_tasklet(xg=True)
+        def _new_game():
+            yield (game.put_async(),
+                   ActiveGamesShard.increment_async(1, attempts))
+        _new_game().get_result()
         return game
 
-    def to_form(self, message):
-        """Returns GameForm representation of the Game"""
+    @classmethod
+    def new_games(cls, games_to_create):
+        """Creates and returns many new games with a single put_multi and a
+        single update of the active games counter. games_to_create is a list
+        of (user, word_to_guess, attempts) tuples. The games are too many
+        entity groups for one transaction, so the counter is updated after
+        they are written."""
+        games = [cls.build(user, word_to_guess, attempts)
+                 for user, word_to_guess, attempts in games_to_create]
+        ndb.put_multi(games)
+        ActiveGamesShard.increment_async(
+            len(games),
+            sum([game.attempts_remaining for game in games])).get_result()
+        return games
+
+    @classmethod
+    def join_event(cls, user, puzzle):
+        """Returns the game of a User in the event of a Puzzle, creating it
+        the first time the User joins. The game is keyed by the Puzzle and
+        the User, so a User has one game per event, and it does not store
+        the word."""
+        key = ndb.Key(cls, 'event:{}:{}'.format(puzzle.key.id(), user.id()))
+
+        @ndb.transactional_tasklet(xg=True)
+        def _join_event():
+            game = yield key.get_async()
+            if game:
+                raise ndb.Return(game)
+            game = cls.build(user, puzzle.word_to_guess, puzzle.attempts,
+                             puzzle.key)
+            game.key = key
+            yield (game.put_async(),
+                   ActiveGamesShard.increment_async(1, puzzle.attempts),
+                   EventResultsShard.add_async(puzzle.key, players=1))
+            raise ndb.Return(game)
+        return _join_event().get_result()
+
+    @classmethod
+    def build(cls, user, word_to_guess, attempts, puzzle=None):
+        """Returns a new game, without writing it. The game of an event gets
+        the key of its Puzzle instead of the word."""
+        state = engine.GameState.new(word_to_guess.lower(), attempts)
+        return cls(user=user,
+                   word_to_guess=None if puzzle else state.word,
+                   puzzle=puzzle,
+                   current_word=state.current_word,
+                   attempts_allowed=attempts,
+                   attempts_remaining=attempts,
+                   letters_tried="",
+                   tried_mask=state.tried_mask,
+                   remaining_mask=state.remaining_mask,
+                   history_codes="",
+                   game_over=False,
+                   cancelled=False)
+
+    def get_word(self):
+        """Returns the word to guess, read from the per instance cache of
+        Puzzles for the games of an event"""
+        if self.puzzle:
+            return Puzzle.get_cached(self.puzzle).word_to_guess
+        return self.word_to_guess
+
+    def state(self):
+        """Returns the engine.GameState of the Game. Games stored before the
+        masks existed get them computed from letters_tried."""
+        if self.tried_mask is None or self.remaining_mask is None:
+            return engine.GameState.from_letters_tried(
+                self.get_word(), self.current_word, self.letters_tried,
+                self.attempts_remaining)
+        return engine.GameState(self.get_word(), self.current_word,
+                                self.tried_mask, self.remaining_mask,
+                                self.attempts_remaining)
+
+    def guess(self, guess):
+        """Plays a lowercase letter and returns the engine outcome. Valid
+        guesses are registered on the Game, with their history code, and the
+        Game is not written."""
+        state = self.state()
+        outcome = state.guess(guess)
+        if outcome not in HISTORY_CODES:
+            return outcome
+
+        # Register the current guess
+        self._migrate_history()
+        self.letters_tried = self.letters_tried + guess
+        self.history_codes = self.history_codes + HISTORY_CODES[outcome]
+        self.current_word = state.current_word
+        self.tried_mask = state.tried_mask
+        self.remaining_mask = state.remaining_mask
+        self.attempts_remaining = state.attempts_remaining
+        return outcome
+
+    def to_form(self, message, user_name=None):
+        """Returns GameForm representation of the Game. The owner is fetched
+        when user_name is not given."""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user.get().name
         form.attempts_remaining = self.attempts_remaining
         form.letters_tried = self.letters_tried
         form.current_word = self.current_word
         form.game_over = self.game_over
         form.cancelled = self.cancelled
-        form.guesses = self.guesses
-        form.messages_history = self.messages_history
+        history = self.history()
+        form.guesses = [guess for guess, _ in history]
+        form.messages_history = [msg for _, msg in history]
         form.message = message
         return form
 
-    def end_game(self, won=False):
-        """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+    @classmethod
+    def to_forms(cls, games, message):
+        """Returns a list of GameForms, resolving all owners in one batch"""
+        user_names = get_user_names([game.user for game in games])
+        return [game.to_form(message, user_names.get(game.user))
+                for game in games]
+
+    @ndb.tasklet
+    def end_game_async(self, won, user_name, counted_attempts=None):
+        """Ends the game and writes its Score. Must run inside the caller's
+        xg transaction. Returns the Score."""
+        if counted_attempts is None:
+            counted_attempts = self.attempts_remaining
         self.game_over = True
-        self.put()
+        word = self.get_word()
         # Add the game to the score 'board'
         score = Score(user=self.user, date=date.today(), won=won,
                       guesses=len(self.letters_tried),
-                      word_to_guess=self.word_to_guess,
+                      word_to_guess=None if self.puzzle else word,
+                      puzzle=self.puzzle,
                       score=(
                       float(self.attempts_remaining) /
                       float(self.attempts_allowed) *
-                      float(len(self.word_to_guess))))
-        score.put()
+                      float(len(word))))
+        yield ndb.put_multi_async([self, score])
+        self.enqueue_record_end(score, user_name, counted_attempts)
+        Leaderboard.enqueue_record(self, score, user_name)
+        raise ndb.Return(score)
+
+    def enqueue_record_end(self, score, user_name, counted_attempts):
+        """Enqueues the task that adds a finished game to the shared
+        counters. Must run inside the transaction that ends the game."""
+        data = {'game': self.key.urlsafe(), 'user': self.user.urlsafe(),
+                'won': score.won, 'score': score.score,
+                'attempts_remaining': counted_attempts}
+        if self.puzzle:
+            data['puzzle'] = self.puzzle.urlsafe()
+            data['entry'] = Leaderboard.make_entry(self, score, user_name)
+        else:
+            data['word'] = score.word_to_guess
+        taskqueue.add(url='/tasks/record_game_end', payload=json.dumps(data),
+                      transactional=True)
+
+    @classmethod
+    def record_end(cls, data):
+        """Adds a finished game to the shared counters, at most once each"""
+        user_key = ndb.Key(urlsafe=data['user'])
+        won = data['won']
+        updates = [
+            ('user_results', lambda: UserResultsShard.add_async(
+                user_key, won, data['score'])),
+            ('active_games', lambda: ActiveGamesShard.increment_async(
+                -1, -data['attempts_remaining']))]
+        if 'word' in data:
+            updates.append(('word_stats',
+                            lambda: WordStatsShard.increment_async(
+                                data['word'], 1, 1 if won else 0)))
+        if 'puzzle' in data:
+            puzzle_key = ndb.Key(urlsafe=data['puzzle'])
+            updates.append(('event_results',
+                            lambda: EventResultsShard.add_async(
+                                puzzle_key, entry=data['entry'])))
+
+        counted_key = ndb.Key(GameEndCounters, data['game'])
+
+        @ndb.transactional_tasklet(xg=True)
+        def _update(name, update):
+            counted = yield counted_key.get_async()
+            if counted is None:
+                counted = GameEndCounters(key=counted_key)
+            if name not in counted.counters:
+                counted.counters.append(name)
+                yield counted.put_async(), update()
+
+        for name, update in updates:
+            _update(name, update).get_result()
 
     def cancel_game(self):
-        """Cancel the game. If game is finished, game cannot be cancelled"""
+        """Cancel the game. If game is finished, game cannot be cancelled.
+        The latest state of the game is read in a transaction, so the game
+        leaves the active games counter exactly once."""
+        @ndb.transactional_tasklet(xg=True)
+        def _cancel_game():
+            game = yield self.key.get_async()
+            if game is None:
+                # Archived games are already over or cancelled
+                raise ndb.Return(self)
+            if not (game.game_over or game.cancelled):
+                game.cancelled = True
+                yield (game.put_async(),
+                       ActiveGamesShard.increment_async(
+                           -1, -game.attempts_remaining))
+            raise ndb.Return(game)
+        self.populate(**_cancel_game().get_result().to_dict())
+
         if self.game_over == True:
             msg = "Game cannot be cancelled because it is already over."
         else:
             msg = "Game successfully cancelled."
-            self.cancelled = True
-            self.put()
         return msg
 
+class GameArchive(ndb.Model):
+    """A finished or cancelled Game moved out of the Game kind, keyed by the
+    id of the Game. Its state is kept in a single compressed value."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    state = ndb.JsonProperty(required=True, compressed=True)
+    archived = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    # Properties of the Game kept in the state
+    STATE_PROPERTIES = ('word_to_guess', 'current_word', 'attempts_allowed',
+                        'attempts_remaining', 'letters_tried', 'history_codes',
+                        'game_over', 'cancelled', 'version')
+
+    @classmethod
+    def from_game(cls, game):
+        """Returns the archive of a Game, without writing it"""
+        game._migrate_history()
+        state = dict((name, getattr(game, name))
+                     for name in cls.STATE_PROPERTIES)
+        # Archives keep the word of event games, so they outlive the Puzzle
+        state['word_to_guess'] = game.get_word()
+        return cls(id=game.key.id(), user=game.user, state=state)
+
+    def to_game(self):
+        """Returns the archived Game, with its original key. It is only meant
+        to be read, never written."""
+        return Game(key=ndb.Key(Game, self.key.id()), user=self.user,
+                    **self.state)
+
+
+class GameEndCounters(ndb.Model):
+    """Names of the shared counters a finished game was already added to,
+    keyed by the urlsafe key of the game. Deleted when the game is
+    archived."""
+    counters = ndb.StringProperty(repeated=True, indexed=False)
+
+
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
@@ -104,12 +752,260 @@ class Score(ndb.Model):
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
     score = ndb.FloatProperty(required=True)
-    word_to_guess = ndb.StringProperty(required=True)
+    word_to_guess = ndb.StringProperty()
+    puzzle = ndb.KeyProperty(kind='Puzzle', indexed=False)
+
+    def get_word(self):
+        """Returns the word of the game. Scores of an event store the key of
+        its Puzzle instead, so the API never shows the word of an event."""
+        if self.puzzle:
+            return Puzzle.get_cached(self.puzzle).word_to_guess
+        return self.word_to_guess
+
+    def to_form(self, user_name=None):
+        """Returns ScoreForm representation of the Score. The owner is
+        fetched when user_name is not given."""
+        return ScoreForm(user_name=user_name or self.user.get().name,
+                         won=self.won, date=str(self.date),
+                         guesses=self.guesses, score=self.score,
+                         word_to_guess=self.word_to_guess)
+
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a list of ScoreForms, resolving all owners in one batch"""
+        user_names = get_user_names([score.user for score in scores])
+        return [score.to_form(user_names.get(score.user)) for score in scores]
+
+class Leaderboard(ndb.Model):
+    """The best MAX_ENTRIES scores of a window of time: a day, an ISO week or
+    all time. Each entry is a dict with the fields of a ScoreForm and the key
+    of its game. Boards are kept in memcache too, so reading one is a single
+    cache hit. The cached copies expire after MEMCACHE_TIME seconds, which
+    bounds how long a race between two recorders can hide an entry."""
+    period = ndb.StringProperty(required=True)
+    start = ndb.DateProperty()
+    entries = ndb.JsonProperty(required=True, default=[])
+
+    MAX_ENTRIES = 100
+    DAY = 'day'
+    WEEK = 'week'
+    ALL_TIME = 'all_time'
+    PERIODS = (DAY, WEEK, ALL_TIME)
+    MEMCACHE_PREFIX = 'LEADERBOARD:'
+    MEMCACHE_TIME = 600
+
+    @classmethod
+    def window(cls, period, day=None):
+        """Returns a tuple with the id and the start date of the window of
+        the period that contains the day (today by default)"""
+        day = day or date.today()
+        if period == cls.DAY:
+            return 'day:{}'.format(day.isoformat()), day
+        if period == cls.WEEK:
+            year, week, weekday = day.isocalendar()
+            return ('week:{}-W{:02d}'.format(year, week),
+                    day - timedelta(days=weekday - 1))
+        return cls.ALL_TIME, None
+
+    @classmethod
+    def get_entries(cls, period):
+        """Returns the entries of the current window of the period"""
+        board_id, _ = cls.window(period)
+        entries = memcache.get(cls.MEMCACHE_PREFIX + board_id)
+        if entries is None:
+            board = cls.get_by_id(board_id)
+            entries = board.entries if board else []
+            memcache.add(cls.MEMCACHE_PREFIX + board_id, entries,
+                         time=cls.MEMCACHE_TIME)
+        return entries
+
+    @staticmethod
+    def make_entry(game, score, user_name):
+        """Returns the entry of the Score of a game"""
+        return {'game': game.key.urlsafe(), 'user_name': user_name,
+                'date': score.date.isoformat(), 'won': score.won,
+                'guesses': score.guesses, 'score': score.score,
+                'word_to_guess': score.word_to_guess}
+
+    @classmethod
+    def enqueue_record(cls, game, score, user_name):
+        """Enqueues the task that records the Score of a game on the boards.
+        Must run inside the transaction that ends the game."""
+        taskqueue.add(url='/tasks/record_high_score',
+                      payload=json.dumps(cls.make_entry(game, score,
+                                                        user_name)),
+                      transactional=True)
+
+    @classmethod
+    def record(cls, entry):
+        """Records an entry on the boards of its day, week and all time.
+        Boards that are full of better scores are skipped without a
+        transaction, and recording an entry twice has no effect."""
+        day = date(*map(int, entry['date'].split('-')))
+        windows = [cls.window(period, day) + (period,)
+                   for period in cls.PERIODS]
+        cached = memcache.get_multi([cls.MEMCACHE_PREFIX + board_id
+                                     for board_id, _, _ in windows])
+        windows = [(board_id, start, period)
+                   for board_id, start, period in windows
+                   if cls._qualifies(cached.get(cls.MEMCACHE_PREFIX +
+                                                board_id), entry)]
+        if not windows:
+            return
+
+        @ndb.transactional(xg=True)
+        def _record():
+            keys = [ndb.Key(cls, board_id) for board_id, _, _ in windows]
+            boards = ndb.get_multi(keys)
+            changed = []
+            for (board_id, start, period), key, board in zip(windows, keys,
+                                                            boards):
+                if board is None:
+                    board = cls(key=key, period=period, start=start)
+                if not any(e['game'] == entry['game'] for e in board.entries):
+                    board.entries = sorted(board.entries + [entry],
+                                           key=lambda e: -e['score'])
+                    board.entries = board.entries[:cls.MAX_ENTRIES]
+                    changed.append(board)
+            ndb.put_multi(changed)
+            return changed
+        for board in _record():
+            memcache.set(cls.MEMCACHE_PREFIX + board.key.id(), board.entries,
+                         time=cls.MEMCACHE_TIME)
+
+    @classmethod
+    def _qualifies(cls, entries, entry):
+        """Returns False if the cached entries of a board are full of scores
+        at least as good as the entry"""
+        return (entries is None or len(entries) < cls.MAX_ENTRIES or
+                entry['score'] > entries[-1]['score'])
+
+    @classmethod
+    def rollover(cls, retention_days):
+        """Creates the boards of the current day and week, so they start
+        cached, and deletes the day boards older than retention_days"""
+        for period in (cls.DAY, cls.WEEK):
+            board_id, start = cls.window(period)
+            board = cls.get_or_insert(board_id, period=period, start=start)
+            memcache.set(cls.MEMCACHE_PREFIX + board_id, board.entries,
+                         time=cls.MEMCACHE_TIME)
+        ndb.delete_multi(cls.query(
+            cls.period == cls.DAY,
+            cls.start < date.today() - timedelta(days=retention_days)).fetch(
+                keys_only=True))
+
+    @staticmethod
+    def entry_to_form(entry):
+        """Returns ScoreForm representation of an entry"""
+        return ScoreForm(user_name=entry['user_name'], won=entry['won'],
+                         date=entry['date'], guesses=entry['guesses'],
+                         score=entry['score'],
+                         word_to_guess=entry['word_to_guess'])
+
+
+class Puzzle(ndb.Model):
+    """Word played by all the players of an event. A Puzzle never changes
+    once created, so each instance keeps the Puzzles it reads in a cache, and
+    the games of the event only store its key."""
+    name = ndb.StringProperty(required=True, indexed=False)
+    word_to_guess = ndb.StringProperty(required=True, indexed=False)
+    attempts = ndb.IntegerProperty(required=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    # Per instance cache of the Puzzles by key
+    _by_key = LruCache(1000)
+
+    @classmethod
+    def get_cached(cls, key):
+        """Returns the Puzzle with the key, or None"""
+        puzzle = cls._by_key.get(key)
+        if puzzle is None:
+            puzzle = key.get()
+            if puzzle:
+                cls._by_key.set(key, puzzle)
+        return puzzle
 
     def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), guesses=self.guesses,
-                         score=self.score, word_to_guess=self.word_to_guess)
+        """Returns EventForm representation of the Puzzle"""
+        return EventForm(urlsafe_key=self.key.urlsafe(), name=self.name,
+                         attempts=self.attempts,
+                         word_length=len(self.word_to_guess))
+
+
+class EventResultsShard(ndb.Model):
+    """Shard of the results of an event: the players who joined and finished
+    it, their wins and sum of scores, and the best MAX_ENTRIES entries of the
+    shard. Players join and finish on a random shard, so the players of an
+    event do not serialize on one entity group. The merged results are
+    cached for MEMCACHE_TIME seconds, so reading them is one cache hit, or one
+    batch get of NUM_SHARDS entities, however many players there are."""
+    players = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    finished = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    score_sum = ndb.FloatProperty(required=True, default=0.0, indexed=False)
+    entries = ndb.JsonProperty(indexed=False)
+
+    NUM_SHARDS = 50
+    MAX_ENTRIES = 100
+    MEMCACHE_PREFIX = 'EVENT_RESULTS:'
+    MEMCACHE_TIME = 5
+
+    @classmethod
+    def shard_keys(cls, puzzle_key):
+        return [ndb.Key(cls, '{}:{}'.format(puzzle_key.id(), i))
+                for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True,
+                               propagation=ndb.TransactionOptions.ALLOWED)
+    def add_async(cls, puzzle_key, players=0, entry=None):
+        """Adds players who joined the event, or the entry of a player who
+        finished it, to a random shard. Joins the transaction of the
+        caller."""
+        key = random.choice(cls.shard_keys(puzzle_key))
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key, entries=[])
+        shard.players += players
+        if entry:
+            shard.finished += 1
+            shard.wins += 1 if entry['won'] else 0
+            shard.score_sum += entry['score']
+            shard.entries = sorted(shard.entries + [entry],
+                                   key=cls._rank)[:cls.MAX_ENTRIES]
+        yield shard.put_async()
+
+    @staticmethod
+    def _rank(entry):
+        return -entry['score'], entry['guesses']
+
+    @classmethod
+    def results(cls, puzzle_key):
+        """Returns a dict with the players, finished, wins, score_sum and
+        best entries of the event"""
+        cache_key = cls.MEMCACHE_PREFIX + str(puzzle_key.id())
+        results = memcache.get(cache_key)
+        if results is None:
+            shards = [shard for shard in ndb.get_multi(
+                cls.shard_keys(puzzle_key)) if shard]
+            results = dict((name, sum([getattr(shard, name)
+                                       for shard in shards]))
+                           for name in ('players', 'finished', 'wins',
+                                        'score_sum'))
+            results['entries'] = heapq.nsmallest(
+                cls.MAX_ENTRIES,
+                [entry for shard in shards for entry in shard.entries],
+                key=cls._rank)
+            memcache.add(cache_key, results, time=cls.MEMCACHE_TIME)
+        return results
+
+    @staticmethod
+    def entry_to_form(entry):
+        """Returns EventEntryForm representation of an entry. The Scores of
+        an event do not store its word, so neither do its entries."""
+        return EventEntryForm(user_name=entry['user_name'], won=entry['won'],
+                              guesses=entry['guesses'], score=entry['score'])
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -127,6 +1023,7 @@ class GameForm(messages.Message):
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 class GameHistoryForm(messages.Message):
     """Form used to show a Game's history"""
@@ -138,15 +1035,31 @@ class GameHistoryForms(messages.Message):
     items = messages.MessageField(GameHistoryForm, 1, repeated=True)
 
 class NewGameForm(messages.Message):
-    """Used to create a new game"""
+    """Used to create a new game. Without word_to_guess, a random word with
+    the optional word_length and difficulty is picked by the server."""
     user_name = messages.StringField(1, required=True)
-    word_to_guess = messages.StringField(2, required=True)
+    word_to_guess = messages.StringField(2)
     attempts = messages.IntegerField(3, default=6)
+    word_length = messages.IntegerField(4)
+    difficulty = messages.StringField(5)
+
+class NewGameForms(messages.Message):
+    """Used to create many new games at once"""
+    items = messages.MessageField(NewGameForm, 1, repeated=True)
 
 class MakeGuessForm(messages.Message):
     """Used to make a guess in an existing game"""
     guess = messages.StringField(1, required=True)
 
+class MakeGuessesForm(messages.Message):
+    """Used to make an ordered list of guesses in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+
+class GuessesResultForm(messages.Message):
+    """Game state after a list of guesses, with the message of each guess"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    results = messages.MessageField(GameHistoryForm, 2, repeated=True)
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -154,16 +1067,18 @@ class ScoreForm(messages.Message):
     won = messages.BooleanField(3, required=True)
     guesses = messages.IntegerField(4, required=True)
     score = messages.FloatField(5, required=True)
-    word_to_guess = messages.StringField(6, required=True)
+    word_to_guess = messages.StringField(6)
 
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 class HighScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     results_to_show = messages.IntegerField(1)
     items = messages.MessageField(ScoreForm, 2, repeated=True)
+    next_page_token = messages.StringField(3)
 
 class RankingForm(messages.Message):
     """RankingForm for showing rankings among users"""
@@ -174,6 +1089,84 @@ class RankingForm(messages.Message):
 class RankingForms(messages.Message):
     """Return multiple RankingForms"""
     items = messages.MessageField(RankingForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm for outbound cache hit and miss counters"""
+    hits = messages.IntegerField(1, required=True)
+    misses = messages.IntegerField(2, required=True)
+    hit_ratio = messages.FloatField(3, required=True)
+
+class UserProfileForm(messages.Message):
+    """UserProfileForm for the aggregated results of a User"""
+    user_name = messages.StringField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    winning_percentage = messages.FloatField(4, required=True)
+    score_sum = messages.FloatField(5, required=True)
+    score_count = messages.IntegerField(6, required=True)
+    average_score = messages.FloatField(7, required=True)
+    best_score = messages.FloatField(8, required=True)
+    current_streak = messages.IntegerField(9, required=True)
+
+class EndpointStatsForm(messages.Message):
+    """EndpointStatsForm for the aggregated instrumentation of an endpoint"""
+    endpoint = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    mean_wall_ms = messages.FloatField(3, required=True)
+    mean_datastore_gets = messages.FloatField(4, required=True)
+    mean_datastore_puts = messages.FloatField(5, required=True)
+    mean_datastore_queries = messages.FloatField(6, required=True)
+    memcache_hit_ratio = messages.FloatField(7, required=True)
+    mean_taskqueue_adds = messages.FloatField(8, required=True)
+    mean_ratelimit_ms = messages.FloatField(9, required=True)
+    throttled = messages.IntegerField(10, required=True)
+    coalesced_reads = messages.IntegerField(11, required=True)
+    guess_conflicts = messages.IntegerField(12, required=True)
+    guess_retries = messages.IntegerField(13, required=True)
+
+class EndpointStatsForms(messages.Message):
+    """Return multiple EndpointStatsForms"""
+    items = messages.MessageField(EndpointStatsForm, 1, repeated=True)
+
+class WordStatsForm(messages.Message):
+    """WordStatsForm for the results of the games of a word"""
+    word = messages.StringField(1, required=True)
+    plays = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    win_rate = messages.FloatField(4, required=True)
+
+class NewEventForm(messages.Message):
+    """Used to create an event. Without word_to_guess, a random word with
+    the optional word_length and difficulty is picked by the server."""
+    name = messages.StringField(1, required=True)
+    word_to_guess = messages.StringField(2)
+    attempts = messages.IntegerField(3, default=6)
+    word_length = messages.IntegerField(4)
+    difficulty = messages.StringField(5)
+
+class EventForm(messages.Message):
+    """EventForm for outbound event information, without the word"""
+    urlsafe_key = messages.StringField(1, required=True)
+    name = messages.StringField(2, required=True)
+    attempts = messages.IntegerField(3, required=True)
+    word_length = messages.IntegerField(4, required=True)
+
+class EventEntryForm(messages.Message):
+    """EventEntryForm for the result of a player of an event"""
+    user_name = messages.StringField(1, required=True)
+    won = messages.BooleanField(2, required=True)
+    guesses = messages.IntegerField(3, required=True)
+    score = messages.FloatField(4, required=True)
+
+class EventResultsForm(messages.Message):
+    """EventResultsForm for the results of an event"""
+    event = messages.MessageField(EventForm, 1, required=True)
+    players = messages.IntegerField(2, required=True)
+    finished = messages.IntegerField(3, required=True)
+    wins = messages.IntegerField(4, required=True)
+    average_score = messages.FloatField(5, required=True)
+    items = messages.MessageField(EventEntryForm, 6, repeated=True)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
@@ -0,0 +1,79 @@
+"""perftools.py - Helpers shared by benchmark.py and coldstart.py: the App
+Engine SDK setup and the baseline each report is compared against. No
+baseline is committed, since the timings depend on the machine and the SDK
+version, so the first run on a machine records one with --save-baseline."""
+
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def add_arguments(parser, baseline_file):
+    """Adds the --sdk and baseline arguments to an argparse parser"""
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path of the google_appengine SDK directory')
+    parser.add_argument('--baseline',
+                        default=os.path.join(ROOT, baseline_file))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Allowed ratio of a time over its baseline')
+
+
+def setup_sdk(sdk):
+    """Puts the App Engine SDK, its bundled libraries and the application on
+    sys.path"""
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def regressions(report, baseline, tolerance, timings, counts):
+    """Returns the regressions of a report, a dict of the stats of each
+    name, against the baseline. The timings may exceed their baseline by the
+    tolerance ratio; the counts do not depend on the machine, so any increase
+    counts."""
+    found = []
+    for name in sorted(report):
+        stats = report[name]
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in timings:
+            if metric in base and stats[metric] > base[metric] * tolerance:
+                found.append('{} {}: {:.2f} (baseline {:.2f})'.format(
+                    name, metric, stats[metric], base[metric]))
+        for metric in counts:
+            if stats[metric] > base[metric] + 0.01:
+                found.append('{} {}: {:g} (baseline {:g})'.format(
+                    name, metric, round(stats[metric], 2),
+                    round(base[metric], 2)))
+    return found
+
+
+def check_baseline(args, report, timings, counts):
+    """Compares the report against the baseline, or saves it as the new
+    baseline with --save-baseline. Exits with status 1 on a regression."""
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print 'No baseline at {}, run with --save-baseline to record one.'\
+            .format(args.baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print 'Baseline saved to {}'.format(args.baseline)
+        return
+    found = regressions(report, baseline, args.tolerance, timings, counts)
+    if found:
+        print '\nRegressions against the baseline:'
+        for regression in found:
+            print ' - ' + regression
+        sys.exit(1)
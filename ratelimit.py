@@ -0,0 +1,118 @@
+"""ratelimit.py - Token bucket rate limiting of the API endpoints, shared by all
+instances through memcache. Each bucket holds up to its capacity in tokens and
+is refilled at a constant rate; a call takes one token from each of its
+buckets and is refused with a 403 error when one of them is empty. The buckets
+of a call are read with one gets and written with one compare-and-set, and
+the limiter fails open when memcache is unavailable or contended."""
+
+import functools
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+import instrumentation
+
+RATE_LIMIT_PREFIX = 'RATE_LIMIT:'
+# (capacity, tokens added per second) of the buckets of each scope. Clients are
+# identified by the user name of the request and by their address, so a client
+# sending a new user name each time is still limited. Addresses are shared by
+# the users behind a proxy and get a larger bucket.
+RATE_LIMITS = {
+    'client': (60, 10.0),
+    'address': (120, 20.0),
+    'game': (20, 4.0),
+}
+RATE_LIMIT_CAS_RETRIES = 2
+
+
+class RateLimitExceededException(endpoints.ForbiddenException):
+    """Rate limit exceeded exception mapped to a 403 response. The endpoints
+    frontend only passes through a few error statuses, and 429 is not one of
+    them."""
+
+
+def rate_limited(func):
+    """Decorator of HangmanApi methods, placed under @instrumented so the time
+    spent in the limiter is part of the endpoint stats"""
+
+    @functools.wraps(func)
+    def wrapper(service, request):
+        start = time.time()
+        try:
+            allowed = take_tokens(_buckets(service, request))
+        finally:
+            instrumentation.add_stat(
+                'ratelimit_us', int(round((time.time() - start) * 1000000)))
+        if not allowed:
+            instrumentation.add_stat('throttled')
+            raise RateLimitExceededException(
+                    'Rate limit exceeded, please retry in a few seconds.')
+        return func(service, request)
+    return wrapper
+
+
+def take_tokens(buckets, now=None):
+    """Takes one token from each bucket.
+    Args:
+        buckets: A dict mapping the name of each bucket to its scope
+        now: The current time in seconds, time.time() if empty
+    Returns:
+        False if a bucket is empty, else True. The tokens are only taken when
+        all the buckets have one."""
+    if not buckets:
+        return True
+    client = memcache.Client()
+    keys = dict((RATE_LIMIT_PREFIX + name, scope)
+                for name, scope in buckets.items())
+    for _ in range(RATE_LIMIT_CAS_RETRIES):
+        current = now or time.time()
+        cached = client.get_multi(keys.keys(), for_cas=True)
+        filled = {}
+        for key, scope in keys.items():
+            capacity, rate = RATE_LIMITS[scope]
+            tokens, updated = cached.get(key, (capacity, current))
+            tokens = min(capacity, tokens + (current - updated) * rate)
+            if tokens < 1:
+                return False
+            filled[key] = (tokens - 1, current)
+
+        new = dict((key, value) for key, value in filled.items()
+                   if key not in cached)
+        existing = dict((key, value) for key, value in filled.items()
+                        if key in cached)
+        # Buckets are dropped once they would be full again
+        failed = []
+        if new:
+            failed += client.add_multi(new, time=_expiry(new, keys))
+        if existing:
+            failed += client.cas_multi(existing, time=_expiry(existing, keys))
+        if not failed:
+            return True
+    # Fail open: contention or an unavailable memcache never refuses a call
+    return True
+
+
+def _expiry(values, scopes):
+    """Returns the seconds until the emptiest of the buckets is full again"""
+    seconds = 1
+    for key, (tokens, _) in values.items():
+        capacity, rate = RATE_LIMITS[scopes[key]]
+        seconds = max(seconds, int((capacity - tokens) / rate) + 1)
+    return seconds
+
+
+def _buckets(service, request):
+    """Returns the buckets of a call, keyed by their name"""
+    buckets = {}
+    client = getattr(request, 'user_name', None)
+    if client:
+        buckets['client:' + client.lower()] = 'client'
+    state = getattr(service, 'request_state', None)
+    address = getattr(state, 'remote_address', None)
+    if address:
+        buckets['address:' + address] = 'address'
+    game = getattr(request, 'urlsafe_game_key', None)
+    if game:
+        buckets['game:' + game] = 'game'
+    return buckets
@@ -0,0 +1,61 @@
+"""test_dictionary.py - Tests of the server side word list.
+
+Usage:
+    python -m unittest discover -p 'test_*.py'"""
+
+import random
+import unittest
+
+import dictionary
+from dictionary import Dictionary, EASY, MEDIUM, HARD
+
+
+class WordDifficultyTest(unittest.TestCase):
+
+    def test_difficulties(self):
+        self.assertEqual(dictionary.word_difficulty('cat'), EASY)
+        # Rare letters count three times
+        self.assertEqual(dictionary.word_difficulty('jazz'), MEDIUM)
+        self.assertEqual(dictionary.word_difficulty('keyboard'), HARD)
+
+
+class DictionaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.words = Dictionary(['cat', 'dog', 'jazz', 'keyboard', 'apple',
+                                 'Not valid', 'cat'])
+        self.rng = random.Random(0)
+
+    def pick_all(self, **kwargs):
+        return set(self.words.random_word(rng=self.rng, **kwargs)
+                   for _ in range(200))
+
+    def test_invalid_and_duplicate_words_are_dropped(self):
+        self.assertEqual(len(self.words), 5)
+
+    def test_any_word(self):
+        self.assertEqual(self.pick_all(),
+                         set(['cat', 'dog', 'jazz', 'keyboard', 'apple']))
+
+    def test_by_length(self):
+        self.assertEqual(self.pick_all(length=3), set(['cat', 'dog']))
+
+    def test_by_difficulty(self):
+        self.assertEqual(self.pick_all(difficulty=HARD), set(['keyboard']))
+
+    def test_by_length_and_difficulty(self):
+        self.assertEqual(self.pick_all(length=4, difficulty=MEDIUM),
+                         set(['jazz']))
+
+    def test_no_matching_word(self):
+        self.assertIsNone(self.words.random_word(length=20))
+        self.assertIsNone(self.words.random_word(length=3, difficulty=HARD))
+
+    def test_words_file(self):
+        words = dictionary.get_dictionary()
+        self.assertTrue(len(words) > 0)
+        self.assertIs(dictionary.get_dictionary(), words)
+
+
+if __name__ == '__main__':
+    unittest.main()
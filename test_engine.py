@@ -0,0 +1,93 @@
+"""test_engine.py - Tests of the datastore free core of the Hangman game.
+
+Usage:
+    python -m unittest discover -p 'test_*.py'"""
+
+import unittest
+
+import engine
+from engine import GameState
+
+
+class GameStateTest(unittest.TestCase):
+
+    def test_new_game(self):
+        state = GameState.new('apple', 6)
+        self.assertEqual(state.current_word, '     ')
+        self.assertEqual(state.tried_mask, 0)
+        self.assertEqual(state.word_remaining, 'apple')
+        self.assertEqual(state.attempts_remaining, 6)
+
+    def test_hit_reveals_every_position(self):
+        state = GameState.new('apple', 6)
+        self.assertEqual(state.guess('p'), engine.HIT)
+        self.assertEqual(state.current_word, ' pp  ')
+        self.assertEqual(state.word_remaining, 'ale')
+        self.assertEqual(state.attempts_remaining, 6)
+
+    def test_miss_costs_an_attempt(self):
+        state = GameState.new('apple', 6)
+        self.assertEqual(state.guess('z'), engine.MISS)
+        self.assertEqual(state.current_word, '     ')
+        self.assertEqual(state.attempts_remaining, 5)
+
+    def test_win(self):
+        state = GameState.new('apple', 6)
+        outcomes = [state.guess(letter) for letter in 'aple']
+        self.assertEqual(outcomes,
+                         [engine.HIT, engine.HIT, engine.HIT, engine.WIN])
+        self.assertEqual(state.current_word, 'apple')
+        self.assertEqual(state.word_remaining, '')
+
+    def test_loss(self):
+        state = GameState.new('apple', 2)
+        self.assertEqual(state.guess('x'), engine.MISS)
+        self.assertEqual(state.guess('y'), engine.LOSS)
+        self.assertEqual(state.attempts_remaining, 0)
+
+    def test_already_tried(self):
+        state = GameState.new('apple', 6)
+        state.guess('a')
+        state.guess('z')
+        self.assertEqual(state.guess('a'), engine.ALREADY_TRIED)
+        self.assertEqual(state.guess('z'), engine.ALREADY_TRIED)
+        self.assertEqual(state.attempts_remaining, 5)
+
+    def test_not_a_letter(self):
+        state = GameState.new('apple', 6)
+        for guess in ('1', '!', 'A', '', '12'):
+            self.assertEqual(state.guess(guess), engine.NOT_A_LETTER, guess)
+        self.assertEqual(state.tried_mask, 0)
+        self.assertEqual(state.attempts_remaining, 6)
+
+    def test_not_one_letter(self):
+        state = GameState.new('apple', 6)
+        self.assertEqual(state.guess('ap'), engine.NOT_ONE_LETTER)
+        self.assertEqual(state.tried_mask, 0)
+        self.assertEqual(state.attempts_remaining, 6)
+
+    def test_from_letters_tried(self):
+        state = GameState.from_letters_tried('apple', 'a    ', 'az', 5)
+        self.assertEqual(state.tried_mask, engine.word_mask('az'))
+        self.assertEqual(state.word_remaining, 'pple')
+        self.assertEqual(state.guess('z'), engine.ALREADY_TRIED)
+        self.assertEqual(state.guess('p'), engine.HIT)
+        self.assertEqual(state.current_word, 'app  ')
+        self.assertEqual(state.guess('l'), engine.HIT)
+        self.assertEqual(state.guess('e'), engine.WIN)
+
+
+class WordTest(unittest.TestCase):
+
+    def test_is_valid_word(self):
+        self.assertTrue(engine.is_valid_word('apple'))
+        for word in ('', 'Apple', 'app le', 'caf\xc3\xa9'):
+            self.assertFalse(engine.is_valid_word(word), word)
+
+    def test_letter_positions(self):
+        self.assertEqual(engine.letter_positions('apple'),
+                         {'a': (0,), 'p': (1, 2), 'l': (3,), 'e': (4,)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""test_export.py - Round trip of the CSV chunks written by export.py through
+the statistics of analytics.py.
+
+Usage:
+    python -m unittest discover -p 'test_*.py'"""
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import analytics
+from export import ChunkedCsvWriter, LocalFileSink, SCORE_COLUMNS
+
+SCORES = [
+    ('1', u'bob', '2016-01-01', 1, 7, 3.5, u'apple'),
+    ('2', u'al\xe9', '2016-01-01', 0, 10, 0.0, u'apple'),
+    ('1', u'bob', '2016-01-02', 1, 7, 4.0, u'cat'),
+    ('1', u'bob', '2016-01-03', 0, 9, 0.0, u'cat'),
+    ('2', u'al\xe9', '2016-01-03', 1, 5, 2.0, u'dog'),
+]
+
+
+class ExportRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        writer = ChunkedCsvWriter(LocalFileSink(self.directory), 'scores',
+                                  SCORE_COLUMNS, chunk_rows=2)
+        for row in SCORES:
+            writer.write(dict(zip(SCORE_COLUMNS, row)))
+        writer.close()
+        self.writer = writer
+        self.scores = analytics.load_columns(self.directory, 'scores')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_chunks(self):
+        self.assertEqual(self.writer.rows, 5)
+        self.assertEqual(self.writer.chunks, 3)
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in
+                   glob.glob(os.path.join(self.directory, '*.csv'))),
+            ['scores-00000.csv', 'scores-00001.csv', 'scores-00002.csv'])
+
+    def test_load_columns(self):
+        self.assertEqual(sorted(self.scores), sorted(SCORE_COLUMNS))
+        self.assertEqual(self.scores['user_name'],
+                         [row[1] for row in SCORES])
+        self.assertEqual(self.scores['won'], [1, 0, 1, 0, 1])
+        self.assertEqual(self.scores['score'], [3.5, 0.0, 4.0, 0.0, 2.0])
+
+    def test_word_stats(self):
+        stats = analytics.word_stats(self.scores)
+        self.assertEqual(sorted(stats), [u'apple', u'cat', u'dog'])
+        self.assertEqual(stats[u'apple'],
+                         {'plays': 2, 'wins': 1, 'win_rate': 0.5,
+                          'mean_score': 1.75, 'best_score': 3.5,
+                          'mean_guesses': 8.5})
+
+    def test_user_stats(self):
+        stats = analytics.user_stats(self.scores)
+        self.assertEqual(stats[u'bob']['plays'], 3)
+        self.assertEqual(stats[u'bob']['wins'], 2)
+        self.assertEqual(stats[u'bob']['best_score'], 4.0)
+        self.assertEqual(stats[u'al\xe9']['mean_score'], 1.0)
+        self.assertEqual(stats[u'al\xe9']['mean_guesses'], 7.5)
+
+    def test_guesses_distribution(self):
+        self.assertEqual(analytics.guesses_distribution(
+            self.scores['guesses']), {5: 1, 7: 2, 9: 1, 10: 1})
+
+    def test_missing_directory(self):
+        self.assertEqual(analytics.load_columns(self.directory, 'games'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,44 @@
 """utils.py - File for collecting general utility functions."""
 
-import logging
+import threading
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+from models import Game, GameArchive, cas_write_versioned
+import instrumentation
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+GAME_CACHE_PREFIX = 'GAME_STATE:'
+GAME_CACHE_TIME = 3600
+GAME_CACHE_HITS = 'GAME_CACHE_HITS'
+GAME_CACHE_MISSES = 'GAME_CACHE_MISSES'
+# Number of lookups counted on an instance before they are added to memcache
+GAME_CACHE_STATS_FLUSH = 50
+
+# Seconds a coalesced read waits for the read it joined before reading alone
+COALESCE_TIMEOUT = 5
+
+_game_cache_stats = {GAME_CACHE_HITS: 0, GAME_CACHE_MISSES: 0}
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string points to, without
+        fetching the entity. Checks that the key is of the correct kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key that the urlsafe Key string points to.
     Raises:
-        ValueError:"""
+        BadRequestException: If the key String is malformed.
+        ValueError: If the key is of the incorrect kind."""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -27,9 +49,144 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def fetch_page(query, page_size=None, page_token=None, **kwargs):
+    """Fetches one page of a query, starting at the cursor in page_token.
+    The page size is capped at MAX_PAGE_SIZE no matter what the client asks.
+    Args:
+        query: The ndb.Query to run
+        page_size: The number of results wanted, DEFAULT_PAGE_SIZE if empty
+        page_token: A urlsafe cursor returned by a previous page, or None
+    Returns:
+        A tuple with the list of results and the token of the next page, which
+        is None when there are no more results.
+    Raises:
+        BadRequestException: If the page size or the token are invalid."""
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException('Page size must be positive')
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    try:
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid page token')
+
+    results, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=cursor,
+                                                  **kwargs)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+def get_game_by_urlsafe(urlsafe):
+    """Returns the Game that the urlsafe key points to and the name of its
+        owner, reading through the game state cache. Misses are read from the
+        datastore, falling back to the archive of finished games, and added
+        to the cache.
+    Args:
+        urlsafe: A urlsafe key string of a Game
+    Returns:
+        A tuple with the Game and the name of its owner, or (None, None) if
+        no Game exists."""
+    key = get_key_by_urlsafe(urlsafe, Game)
+    cached = memcache.get(GAME_CACHE_PREFIX + urlsafe)
+    if cached is not None:
+        _count_game_cache_lookup(GAME_CACHE_HITS)
+        version, serialized_game, user_name = cached
+        return (ndb.model_from_protobuf(entity_pb.EntityProto(serialized_game)),
+                user_name)
+
+    _count_game_cache_lookup(GAME_CACHE_MISSES)
+    game = key.get()
+    if not game:
+        archive = GameArchive.get_by_id(key.id())
+        if not archive:
+            return None, None
+        game = archive.to_game()
+    user_name = game.user.get().name
+    cache_game(game, user_name)
+    return game, user_name
+
+
+class _InFlightRead(object):
+    """A read shared by the concurrent requests of an instance"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def get_game_by_urlsafe_coalesced(urlsafe):
+    """Same as get_game_by_urlsafe, but concurrent calls for the same key on
+    this instance share a single read: the first call reads the game and the
+    others wait for its result. The Game returned is shared by those calls,
+    so it must not be modified."""
+    with _in_flight_lock:
+        read = _in_flight.get(urlsafe)
+        leader = read is None
+        if leader:
+            read = _in_flight[urlsafe] = _InFlightRead()
+
+    if not leader:
+        if read.done.wait(COALESCE_TIMEOUT):
+            instrumentation.add_stat('coalesced_reads')
+            if read.error:
+                raise read.error
+            return read.result
+        return get_game_by_urlsafe(urlsafe)
+
+    try:
+        read.result = get_game_by_urlsafe(urlsafe)
+    except Exception, e:
+        read.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[urlsafe]
+        read.done.set()
+    return read.result
+
+
+def cache_game(game, user_name):
+    """Writes the state of a Game through to the game state cache. The write
+    is a compare-and-set that never replaces a newer version of the game, so
+    concurrent writers and readers cannot leave a stale state behind. If the
+    compare-and-set keeps failing the entry is dropped instead.
+    Args:
+        game: The Game, as last written to the datastore
+        user_name: The name of the owner of the Game"""
+    cas_write_versioned(GAME_CACHE_PREFIX + game.key.urlsafe(), game.version,
+                        (ndb.model_to_protobuf(game).Encode(), user_name),
+                        GAME_CACHE_TIME)
+
+
+def get_game_cache_stats():
+    """Returns a tuple with the hits and misses of the game state cache"""
+    _flush_game_cache_stats()
+    stats = memcache.get_multi([GAME_CACHE_HITS, GAME_CACHE_MISSES])
+    return (stats.get(GAME_CACHE_HITS, 0), stats.get(GAME_CACHE_MISSES, 0))
+
+
+def _count_game_cache_lookup(counter):
+    """Counts a hit or a miss on this instance, adding the counts to memcache
+    every GAME_CACHE_STATS_FLUSH lookups"""
+    _game_cache_stats[counter] += 1
+    if sum(_game_cache_stats.values()) >= GAME_CACHE_STATS_FLUSH:
+        _flush_game_cache_stats()
+
+
+def _flush_game_cache_stats():
+    """Adds the counts of this instance to the counters in memcache"""
+    offsets = dict((counter, count)
+                   for counter, count in _game_cache_stats.items() if count)
+    if offsets:
+        memcache.offset_multi(offsets, initial_value=0)
+        for counter in offsets:
+            _game_cache_stats[counter] = 0